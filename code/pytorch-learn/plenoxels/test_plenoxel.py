@@ -1,12 +1,43 @@
+import json
+import math
+import os
+import tempfile
 import unittest
 
 import torch
+from torchvision import datasets, transforms
+from torchvision.utils import save_image
 
+from volumetric_rendering_with_tv_pruning import Camera
+from volumetric_rendering_with_tv_pruning import ClampingFunctions
+from volumetric_rendering_with_tv_pruning import DebugCapture
+from volumetric_rendering_with_tv_pruning import MultiViewRenderer
 from volumetric_rendering_with_tv_pruning import PlenoxelModel
+from volumetric_rendering_with_tv_pruning import RayStore
+from volumetric_rendering_with_tv_pruning import RenderPool
+from volumetric_rendering_with_tv_pruning import Renderer
+from volumetric_rendering_with_tv_pruning import SPHERICAL_HARMONICS
+from volumetric_rendering_with_tv_pruning import SparseVoxelGrid
+from volumetric_rendering_with_tv_pruning import SphericalHarmonics
+from volumetric_rendering_with_tv_pruning import TrainingImageCache
 from volumetric_rendering_with_tv_pruning import Voxel
 from volumetric_rendering_with_tv_pruning import VoxelAccess
+from volumetric_rendering_with_tv_pruning import ViewLoader
 from volumetric_rendering_with_tv_pruning import VoxelGrid
+from volumetric_rendering_with_tv_pruning import build_optimizer
+from volumetric_rendering_with_tv_pruning import cauchy_term
+from volumetric_rendering_with_tv_pruning import fullscreen_samples
+from volumetric_rendering_with_tv_pruning import masked_step
 from volumetric_rendering_with_tv_pruning import modify_grad
+from volumetric_rendering_with_tv_pruning import mse
+from volumetric_rendering_with_tv_pruning import prune_voxels2
+from volumetric_rendering_with_tv_pruning import ray_batch_samples
+from volumetric_rendering_with_tv_pruning import samples_to_image
+from volumetric_rendering_with_tv_pruning import scale_up_model
+from volumetric_rendering_with_tv_pruning import training_model
+from volumetric_rendering_with_tv_pruning import tv_at
+from volumetric_rendering_with_tv_pruning import tv_over_grid
+from volumetric_rendering_with_tv_pruning import write_view_manifest
 
 
 class PlenoxelTest(unittest.TestCase):
@@ -24,7 +55,7 @@ class PlenoxelTest(unittest.TestCase):
 
     def test_can_scale_up_world(self):
         upscaled_world = self.world.scale_up()
-        self.assertEqual((2, 2, 2), upscaled_world.voxel_grid.shape)
+        self.assertEqual((2, 2, 2, VoxelGrid.VOXEL_DIMENSION), upscaled_world.voxel_grid.shape)
         self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, upscaled_world.voxel_by_position(0, 0, 0)))
         self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, upscaled_world.voxel_by_position(0, 0, 1)))
         self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, upscaled_world.voxel_by_position(0, 1, 0)))
@@ -34,6 +65,41 @@ class PlenoxelTest(unittest.TestCase):
         self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, upscaled_world.voxel_by_position(1, 1, 0)))
         self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, upscaled_world.voxel_by_position(1, 1, 1)))
 
+    def test_trilinear_scale_up_renders_like_original_world(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world.set_pruned((0, 0, 0))
+        upscaled_world = world.scale_up(mode="trilinear")
+        world_positions = torch.rand([50, 3]) * 3
+
+        self.assertEqual((6, 6, 6, VoxelGrid.VOXEL_DIMENSION), upscaled_world.voxel_grid.shape)
+        self.assertTrue(torch.allclose(world.interpolate(world_positions), upscaled_world.interpolate(world_positions),
+                                       atol=1e-5))
+        # Only the child sitting on the pruned voxel is interpolated from pruned voxels alone
+        self.check_pruned(upscaled_world.voxel_by_position(0, 0, 0))
+        self.assertFalse(upscaled_world.pruned[1, 0, 0])
+        self.assertEqual(1, int(upscaled_world.pruned.sum()))
+
+    def test_scaling_up_model_carries_optimizer_state_to_child_voxels(self):
+        world = VoxelGrid.build_random_world(2, 2, 2)
+        world.set_pruned((0, 0, 0))
+        model = PlenoxelModel(world)
+        optimizer = build_optimizer(model)
+        (model.voxel_grid * torch.rand(model.voxel_grid.shape)).sum().backward()
+        optimizer.step()
+
+        fine_model, fine_optimizer = scale_up_model(model, optimizer, mode="nearest")
+        coarse_state = optimizer.state[model.voxel_grid]
+        fine_state = fine_optimizer.state[fine_model.voxel_grid]
+        self.assertEqual((4, 4, 4, VoxelGrid.VOXEL_DIMENSION), fine_state["square_avg"].shape)
+        self.assertTrue(torch.equal(coarse_state["square_avg"][1, 0, 1], fine_state["square_avg"][3, 1, 2]))
+        self.assertTrue(torch.equal(coarse_state["momentum_buffer"][0, 1, 1], fine_state["momentum_buffer"][1, 2, 3]))
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ZEROES, fine_state["momentum_buffer"][1, 1, 0]))
+        self.assertTrue(fine_model.world().pruned[1, 1, 0])
+
+        fine_model.voxel_grid.sum().backward()
+        fine_optimizer.step()
+        self.check_pruned(fine_model.world().voxel_by_position(1, 1, 0))
+
     def test_can_prune_voxel(self):
         world = VoxelGrid.build_with_voxel(1, 1, 1, torch.tensor([0.0001] + [1] * (VoxelGrid.VOXEL_DIMENSION - 1)))
         world.prune([0, 0, 0])
@@ -47,11 +113,25 @@ class PlenoxelTest(unittest.TestCase):
         self.assertFalse(world.voxel_by_position(0, 0, 0).requires_grad)
         self.assertFalse(Voxel.is_pruned(world.voxel_by_position(0, 0, 0)))
 
+    def test_prunes_whole_grid_like_pruning_voxel_by_voxel(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        with torch.no_grad():
+            world.voxel_grid[..., 0] = torch.rand([4, 4, 4]) * 0.22
+        voxel_by_voxel_world = VoxelGrid.copy_from(world)
+        for i, j, k, _ in voxel_by_voxel_world.all_voxels():
+            voxel_by_voxel_world.prune([i, j, k])
+
+        pruned_voxels = prune_voxels2(world)
+        self.assertEqual(int(voxel_by_voxel_world.pruned.sum()), len(pruned_voxels))
+        self.assertTrue(torch.equal(voxel_by_voxel_world.pruned, world.pruned))
+        self.assertTrue(torch.equal(voxel_by_voxel_world.voxel_grid, world.voxel_grid))
+        self.assertFalse(world.pruning_mask().any())
+
     def test_can_propagate_pruned_property_through_scaling_up(self):
         world = VoxelGrid.build_with_voxel(1, 1, 1, torch.tensor([0.0001] + [1] * (VoxelGrid.VOXEL_DIMENSION - 1)))
         world.prune([0, 0, 0])
         upscaled_world = world.scale_up()
-        self.assertEqual((2, 2, 2), upscaled_world.voxel_grid.shape)
+        self.assertEqual((2, 2, 2, VoxelGrid.VOXEL_DIMENSION), upscaled_world.voxel_grid.shape)
         self.check_pruned(upscaled_world.voxel_by_position(0, 0, 0))
         self.check_pruned(upscaled_world.voxel_by_position(0, 0, 0))
         self.check_pruned(upscaled_world.voxel_by_position(0, 0, 1))
@@ -66,35 +146,559 @@ class PlenoxelTest(unittest.TestCase):
         world = VoxelGrid.build_with_voxel(1, 1, 1, torch.tensor([0.0001] + [1] * (VoxelGrid.VOXEL_DIMENSION - 1)))
         world.prune([0, 0, 0])
         model = PlenoxelModel(world)
-        for p in model.parameters():
-            self.check_pruned(p)
+        self.check_pruned(model.world().voxel_by_position(0, 0, 0))
 
     def test_modify_grad_does_not_touch_pruned_voxels(self):
         original_world = VoxelGrid.build_with_voxel(2, 2, 2,
                                                     torch.tensor([0.0001] + [1] * (VoxelGrid.VOXEL_DIMENSION - 1)))
-        for _, _, _, v in original_world.all_voxels():
-            Voxel.prune(v)
+        for i, j, k, _ in original_world.all_voxels():
+            original_world.set_pruned((i, j, k))
         model = PlenoxelModel(original_world)
         world = model.parameter_world
-        view_points = [[0, 0, 0]]
-        ray_sample_positions = [[1, 1, 1]]
-        voxel_pointers = [[0, 8, 1]]
-        all_voxels = world.voxel_grid.flatten().tolist()
-        all_voxel_positions = [
-            torch.tensor([0, 0, 0]),
-            torch.tensor([0, 0, 1]),
-            torch.tensor([0, 1, 0]),
-            torch.tensor([0, 1, 1]),
-            torch.tensor([1, 0, 0]),
-            torch.tensor([1, 0, 1]),
-            torch.tensor([1, 1, 0]),
-            torch.tensor([1, 1, 1]),
-        ]
-        access = VoxelAccess(view_points, ray_sample_positions, voxel_pointers, all_voxels, all_voxel_positions)
+        view_points = torch.tensor([[0., 0.]])
+        ray_sample_positions = torch.tensor([[[1., 1., 1.]]])
+        ray_sample_distances = torch.tensor([[1.]])
+        sample_mask = torch.tensor([[True]])
+        voxel_positions = torch.tensor([[[[0, 0, 0],
+                                          [0, 0, 1],
+                                          [0, 1, 0],
+                                          [0, 1, 1],
+                                          [1, 0, 0],
+                                          [1, 0, 1],
+                                          [1, 1, 0],
+                                          [1, 1, 1]]]])
+        access = VoxelAccess(view_points, ray_sample_positions, ray_sample_distances, sample_mask, voxel_positions)
         modify_grad(world, access)
 
-        for p in model.parameters():
-            self.check_pruned(p)
+        self.assertFalse(world.trainable().any())
+        for _, _, _, v in world.all_voxels():
+            self.check_pruned(v)
+
+    def test_stores_world_as_single_dense_tensor(self):
+        world = VoxelGrid.build_random_world(4, 5, 6)
+        self.assertEqual((4, 5, 6, VoxelGrid.VOXEL_DIMENSION), world.voxel_grid.shape)
+        self.assertTrue(world.voxel_grid.is_contiguous())
+        world.set((1, 2, 3), PlenoxelTest.ALL_ONES)
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, world.voxel_grid[1, 2, 3]))
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, world.at(1.5, 2.5, 3.5)))
+
+    def test_model_holds_world_as_single_parameter(self):
+        model = PlenoxelModel(VoxelGrid.build_random_world(3, 3, 3))
+        self.assertEqual(1, len(list(model.parameters())))
+        self.assertIn("pruned", model.state_dict())
+
+    def test_pruned_voxels_receive_no_gradient(self):
+        world = VoxelGrid.build_with_voxel(2, 1, 1, PlenoxelTest.ALL_ONES)
+        world.set_pruned((0, 0, 0))
+        model = PlenoxelModel(world)
+        model.voxel_grid.sum().backward()
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ZEROES, model.voxel_grid.grad[0, 0, 0]))
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, model.voxel_grid.grad[1, 0, 0]))
+
+    def test_masked_step_leaves_untouched_voxels_and_their_state_alone(self):
+        model = PlenoxelModel(VoxelGrid.build_random_world(2, 1, 1))
+        optimizer = build_optimizer(model)
+        model.voxel_grid.sum().backward()
+        masked_step(optimizer, model)
+
+        model.world().activated = torch.tensor([[[False]], [[True]]])
+        untouched_voxel = model.voxel_grid[0, 0, 0].detach().clone()
+        touched_voxel = model.voxel_grid[1, 0, 0].detach().clone()
+        untouched_momentum = optimizer.state[model.voxel_grid]["momentum_buffer"][0, 0, 0].clone()
+        optimizer.zero_grad()
+        model.voxel_grid.sum().backward()
+        masked_step(optimizer, model)
+
+        self.assertTrue(torch.equal(untouched_voxel, model.voxel_grid[0, 0, 0]))
+        self.assertTrue(torch.equal(untouched_momentum, optimizer.state[model.voxel_grid]["momentum_buffer"][0, 0, 0]))
+        self.assertFalse(torch.equal(touched_voxel, model.voxel_grid[1, 0, 0]))
+
+    def test_masked_step_matches_optimizer_step_on_trainable_voxels(self):
+        world = VoxelGrid.build_random_world(3, 2, 2)
+        model = PlenoxelModel(world)
+        reference_model = PlenoxelModel(world)
+        optimizer = build_optimizer(model)
+        reference_optimizer = build_optimizer(reference_model)
+        for _ in range(3):
+            optimizer.zero_grad()
+            reference_optimizer.zero_grad()
+            model.voxel_grid.pow(2).sum().backward()
+            reference_model.voxel_grid.pow(2).sum().backward()
+            masked_step(optimizer, model)
+            reference_optimizer.step()
+
+        self.assertTrue(torch.allclose(reference_model.voxel_grid, model.voxel_grid))
+        for name in ["square_avg", "momentum_buffer"]:
+            self.assertTrue(torch.allclose(reference_optimizer.state[reference_model.voxel_grid][name],
+                                           optimizer.state[model.voxel_grid][name]))
+
+    def test_can_prune_model_through_mask(self):
+        model = PlenoxelModel(VoxelGrid.build_with_voxel(2, 1, 1, PlenoxelTest.ALL_ONES))
+        model.prune(torch.tensor([[[True]], [[False]]]))
+        self.check_pruned(model.world().voxel_by_position(0, 0, 0))
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ONES, model.world().voxel_by_position(1, 0, 0)))
+
+    def test_builds_rays_as_batched_tensors(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-1., 1., -1., 1., 3, 3])
+        ray_spec = torch.tensor([20, 41])
+        renderer = Renderer(world, camera, view_spec, ray_spec)
+        voxel_access = renderer.build_rays(torch.tensor([[0., 0.], [1., 1.]]))
+
+        # Only the central ray passes through the grid, with samples at z = 0, 0.5, ..., 3.5
+        self.assertEqual(1, voxel_access.num_rays())
+        self.assertEqual((1, 7, 8, 3), voxel_access.voxel_positions.shape)
+        self.assertEqual(7, int(voxel_access.sample_mask.sum()))
+        self.assertTrue(torch.equal(torch.tensor([2., 2., 0.]), voxel_access.ray_sample_positions[0, 0]))
+        self.assertTrue(torch.equal(torch.tensor([3, 3, 1]), voxel_access.voxel_positions[0, 0, 7]))
+        self.assertTrue(torch.allclose(torch.full([7], 0.5), voxel_access.ray_sample_distances[0]))
+
+    def test_intersects_rays_with_world_bounds(self):
+        world = VoxelGrid.build_empty_world(4, 4, 4)
+        t_near, t_far = world.ray_intersections(torch.tensor([2., 2., -10.]),
+                                                torch.tensor([[0., 0., 1.], [0., 1., 0.], [0.6, 0., 0.8]]))
+
+        self.assertTrue(torch.allclose(torch.tensor([10., 14.]), torch.stack([t_near[0], t_far[0]])))
+        # One ray runs parallel to the world outside its Z extent, the other passes beside it
+        self.assertGreater(t_near[1], t_far[1])
+        self.assertGreater(t_near[2], t_far[2])
+
+    def test_redistributes_sample_budget_inside_world(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        renderer = Renderer(world, camera, torch.tensor([-1., 1., -1., 1., 3, 3]), torch.tensor([20, 41]),
+                            redistribute_samples=True)
+        voxel_access = renderer.build_rays(torch.tensor([[0., 0.]]))
+
+        # All 41 samples fall inside the world, and every one but the last has a next sample inside it
+        self.assertEqual(40, int(voxel_access.sample_mask.sum()))
+        self.assertTrue(torch.allclose(torch.full([40], 0.1), voxel_access.ray_sample_distances[0, :40], atol=1e-4))
+
+    def test_occupancy_grid_follows_pruning(self):
+        model = PlenoxelModel(VoxelGrid.build_random_world(8, 4, 4))
+        self.assertTrue(model.world().occupancy_grid().all())
+
+        # Samples in the first cell also interpolate voxels at x = 4, so those must be pruned too
+        pruning_mask = torch.zeros([8, 4, 4], dtype=torch.bool)
+        pruning_mask[:4] = True
+        model.prune(pruning_mask)
+        self.assertTrue(model.world().occupancy_grid().all())
+        pruning_mask[4] = True
+        model.prune(pruning_mask)
+        self.assertTrue(torch.equal(torch.tensor([[[False]], [[True]]]), model.world().occupancy_grid()))
+
+    def test_occupancy_grid_follows_a_replaced_pruned_mask(self):
+        world = VoxelGrid.build_random_world(8, 4, 4)
+        self.assertTrue(world.occupancy_grid().all())
+        world.pruned = torch.ones([8, 4, 4], dtype=torch.bool)
+        self.assertFalse(world.occupancy_grid().any())
+
+    def test_skipping_empty_space_does_not_change_rendering(self):
+        world = VoxelGrid.build_random_world(8, 4, 4)
+        for i, j, k, _ in world.all_voxels():
+            if i <= 4:
+                world.set_pruned((i, j, k))
+        unpruned_world = VoxelGrid(world.voxel_grid, scale=world.scale)
+        camera = Camera(2, torch.tensor([4., 2., -10., 1.]), torch.tensor([4., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.6, 0.6, -0.3, 0.3, 7, 3])
+        renderer = Renderer(world, camera, view_spec, torch.tensor([20, 41]))
+        unskipped_renderer = Renderer(unpruned_world, camera, view_spec, torch.tensor([20, 41]))
+
+        voxel_access = renderer.build_rays(fullscreen_samples(view_spec))
+        unskipped_access = unskipped_renderer.build_rays(fullscreen_samples(view_spec))
+        self.assertEqual(unskipped_access.num_rays(), voxel_access.num_rays())
+        self.assertLess(int(voxel_access.sample_mask.sum()), int(unskipped_access.sample_mask.sum()))
+        for channel, unskipped_channel in zip(renderer.render_from_rays(voxel_access),
+                                              unskipped_renderer.render_from_rays(unskipped_access)):
+            self.assertTrue(torch.allclose(unskipped_channel, channel, atol=1e-6))
+
+    def test_terminates_rays_once_transmittance_saturates(self):
+        opaque_voxel = torch.zeros(VoxelGrid.VOXEL_DIMENSION)
+        opaque_voxel[0] = 10.
+        opaque_voxel[1] = 0.5
+        world = VoxelGrid.build_with_voxel(4, 4, 4, opaque_voxel)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3])
+        renderer = Renderer(world, camera, view_spec, torch.tensor([20, 41]), transmittance_threshold=1e-3)
+        full_renderer = Renderer(world, camera, view_spec, torch.tensor([20, 41]))
+
+        terminated_image = renderer.render()
+        self.assertGreater(renderer.num_terminated_samples, 0)
+        for terminated_channel, channel in zip(terminated_image, full_renderer.render()):
+            self.assertTrue(torch.allclose(channel, terminated_channel, atol=1e-2))
+
+        num_terminated_samples = renderer.num_terminated_samples
+        with RenderPool(world, num_workers=2, tile_size=4) as render_pool:
+            renderer.render(render_pool=render_pool)
+        self.assertEqual(num_terminated_samples, renderer.num_terminated_samples)
+
+    def test_terminated_rays_only_propagate_gradients_to_contributing_samples(self):
+        opaque_voxel = torch.zeros(VoxelGrid.VOXEL_DIMENSION)
+        opaque_voxel[0] = 10.
+        opaque_voxel[1] = 0.5
+        model = PlenoxelModel(VoxelGrid.build_with_voxel(4, 4, 4, opaque_voxel), transmittance_threshold=1e-3)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        r, _, _, _, _ = model([camera, torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3]), torch.tensor([20, 41])])
+        r[:, 2].sum().backward()
+
+        # Only the samples at z = 0 and z = 0.5 get through before the transmittance falls below 1e-3
+        self.assertNotEqual(0., float(model.voxel_grid.grad[2, 2, 0].abs().sum()))
+        self.assertEqual(0., float(model.voxel_grid.grad[:, :, 2:].abs().sum()))
+
+    def test_cached_rays_render_the_same_as_freshly_built_rays(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        model = PlenoxelModel(world)
+        uncached_model = PlenoxelModel(world, cache_rays=False)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec, ray_spec = torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3]), torch.tensor([20, 41])
+        pruning_mask = torch.zeros([4, 4, 4], dtype=torch.bool)
+        pruning_mask[:, :, 2:] = True
+
+        for prune in [False, True]:
+            if prune:
+                model.prune(pruning_mask)
+                uncached_model.prune(pruning_mask)
+            cached_r, cached_g, cached_b, _, _ = model([camera, view_spec, ray_spec])
+            r, g, b, _, _ = uncached_model([camera, view_spec, ray_spec])
+            for cached_channel, channel in zip([cached_r, cached_g, cached_b], [r, g, b]):
+                self.assertTrue(torch.allclose(channel, cached_channel, atol=1e-6))
+
+        self.assertEqual(1, len(model.ray_cache))
+        self.assertEqual(1, model.ray_cache.num_hits)
+
+    def test_stored_rays_are_reused_across_models_until_the_ray_spec_changes(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3])
+        with tempfile.TemporaryDirectory() as folder:
+            model = PlenoxelModel(world, ray_cache=RayStore(folder))
+            r, _, _, _, _ = model([camera, view_spec, torch.tensor([20, 41])])
+
+            restarted_model = PlenoxelModel(world, ray_cache=RayStore(folder))
+            stored_r, _, _, _, _ = restarted_model([camera, view_spec, torch.tensor([20, 41])])
+            self.assertEqual(0, restarted_model.ray_cache.num_misses)
+            self.assertTrue(torch.allclose(r, stored_r, atol=1e-6))
+
+            restarted_model([camera, view_spec, torch.tensor([20, 81])])
+            self.assertEqual(1, restarted_model.ray_cache.num_misses)
+
+    def test_only_full_image_training_stores_rays(self):
+        world = VoxelGrid.build_random_world(2, 2, 2)
+        self.assertIsInstance(training_model(world).ray_cache, RayStore)
+        self.assertIsNone(training_model(world, ray_batches_per_epoch=10).ray_cache)
+
+    def test_stored_rays_are_rebuilt_if_their_manifest_is_stale(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec, ray_spec = torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3]), torch.tensor([20, 41])
+        with tempfile.TemporaryDirectory() as folder:
+            model = PlenoxelModel(world, ray_cache=RayStore(folder))
+            r, _, _, _, _ = model([camera, view_spec, ray_spec])
+            entry_folder = model.ray_cache.entry_folder(next(iter(model.ray_cache.entries)))
+            manifest_filename = f"{entry_folder}/{RayStore.MANIFEST_FILENAME}"
+
+            for field, stale_value in [("version", RayStore.FORMAT_VERSION + 1), ("key", [])]:
+                with open(manifest_filename) as manifest_file:
+                    manifest = json.load(manifest_file)
+                manifest[field] = stale_value
+                with open(manifest_filename, "w") as manifest_file:
+                    json.dump(manifest, manifest_file)
+
+                restarted_model = PlenoxelModel(world, ray_cache=RayStore(folder))
+                rebuilt_r, _, _, _, _ = restarted_model([camera, view_spec, ray_spec])
+                self.assertEqual(1, restarted_model.ray_cache.num_misses)
+                self.assertTrue(torch.allclose(r, rebuilt_r, atol=1e-6))
+
+    def test_multi_view_ray_batch_renders_like_each_camera_on_its_own(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        cameras = [Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.])),
+                   Camera(2, torch.tensor([-10., 2., 2., 1.]), torch.tensor([2., 2., 2., 1.]))]
+        view_spec, ray_spec = torch.tensor([-0.2, 0.2, -0.2, 0.2, 3, 3]), torch.tensor([20, 41])
+        view_points = fullscreen_samples(view_spec)
+        camera_indices = torch.arange(len(view_points)) % 2
+
+        renderer = MultiViewRenderer(world, cameras, camera_indices, view_spec, ray_spec)
+        batch_channels = renderer.render_from_rays(renderer.build_rays(view_points))
+        self.assertEqual(len(view_points), len(batch_channels[0]))
+        for index, camera in enumerate(cameras):
+            camera_renderer = Renderer(world, camera, view_spec, ray_spec)
+            camera_rays = camera_indices == index
+            channels = camera_renderer.render_from_rays(camera_renderer.build_rays(view_points[camera_rays]))
+            for batch_channel, channel in zip(batch_channels, channels):
+                self.assertTrue(torch.allclose(channel, batch_channel[camera_rays], atol=1e-5))
+
+    def test_training_images_are_decoded_once_until_the_folder_changes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            image_folder, cache_folder = f"{folder}/images", f"{folder}/cache"
+            os.makedirs(f"{image_folder}/training")
+            for index in range(3):
+                save_image(torch.rand([3, 4, 5]), f"{image_folder}/training/{index:02}.png")
+            decoded_images = torch.stack([image for image, _ in
+                                          datasets.ImageFolder(image_folder, transform=transforms.ToTensor())])
+
+            cache = TrainingImageCache(image_folder, cache_folder)
+            images = cache.load(torch.rand([3, 4]))
+            self.assertEqual((3, 3, 4, 5), images.shape)
+            self.assertTrue(torch.allclose(decoded_images, images.float(), atol=1e-3))
+
+            manifest = cache.manifest()
+            self.assertTrue(torch.equal(images, TrainingImageCache(image_folder, cache_folder).load()))
+            self.assertEqual(manifest, cache.manifest())
+            self.assertEqual((3, 4), cache.camera_positions().shape)
+
+            save_image(torch.rand([3, 4, 5]), f"{image_folder}/training/03.png")
+            self.assertEqual(4, len(cache.load()))
+
+    def test_loads_batches_of_cameras_and_images_from_view_manifest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            image_folder = f"{folder}/images"
+            os.makedirs(f"{image_folder}/training")
+            for index in range(3):
+                save_image(torch.rand([3, 4, 5]), f"{image_folder}/training/{index:02}.png")
+            decoded_images = torch.stack([image for image, _ in
+                                          datasets.ImageFolder(image_folder, transform=transforms.ToTensor())])
+            camera_positions = torch.tensor([[10., 2., 3., 1.], [-4., 10., 5., 1.], [3., -2., 10., 1.]])
+            write_view_manifest(f"{image_folder}/views.json", image_folder, camera_positions,
+                                torch.tensor([0., 0., 0., 1.]), 2.)
+
+            view_loader = ViewLoader(f"{image_folder}/views.json", batch_size=2, shuffle=False,
+                                     cache_folder=f"{folder}/cache")
+            batches = list(view_loader)
+            self.assertEqual(2, len(view_loader))
+            self.assertEqual([2, 1], [len(images) for _, images in batches])
+            cameras = [camera for batch_cameras, _ in batches for camera in batch_cameras]
+            self.assertTrue(torch.equal(camera_positions, torch.stack([camera.center for camera in cameras])))
+            self.assertEqual(2., cameras[0].focal_length)
+            images = torch.cat([images for _, images in batches])
+            self.assertTrue(torch.allclose(decoded_images, images.float(), atol=1e-3))
+
+    def test_samples_ray_batches_across_all_views(self):
+        camera_indices, view_points = ray_batch_samples(1000, 5, [-1., 1., -0.5, 0.5, 10, 10])
+        self.assertEqual((1000, 2), view_points.shape)
+        self.assertTrue(((view_points[:, 0] >= -1.) & (view_points[:, 0] <= 1.)).all())
+        self.assertTrue(((view_points[:, 1] >= -0.5) & (view_points[:, 1] <= 0.5)).all())
+        self.assertEqual(set(range(5)), set(camera_indices.tolist()))
+
+    def test_composites_batch_of_rays_with_cumulative_transmittance(self):
+        world = VoxelGrid.build_empty_world(1, 1, 1)
+        red_voxel = torch.zeros(VoxelGrid.VOXEL_DIMENSION)
+        red_voxel[0] = 1.
+        red_voxel[1] = 1.
+        sample_voxels = red_voxel.repeat(2, 3, 1)
+        ray_sample_distances = torch.ones([2, 3])
+        sample_mask = torch.tensor([[True, True, False], [True, False, False]])
+
+        color_densities = world.channel_opacities(sample_voxels, ray_sample_distances, sample_mask,
+                                                  SPHERICAL_HARMONICS.basis_from_angles(torch.tensor([0., 0.])))
+
+        red = 0.5 * math.sqrt(1. / math.pi)
+        absorbed = 1 - math.exp(-1)
+        expected_two_samples = red * (math.exp(-1) * absorbed + math.exp(-2) * absorbed)
+        expected_one_sample = red * math.exp(-1) * absorbed
+        self.assertTrue(torch.allclose(torch.tensor([[expected_two_samples, 0., 0.],
+                                                     [expected_one_sample, 0., 0.]]), color_densities))
+
+    def test_batched_rendering_matches_rendering_ray_by_ray(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.3, 0.3, -0.3, 0.3, 5, 5])
+        renderer = Renderer(world, camera, view_spec, torch.tensor([20, 41]))
+        voxel_access = renderer.build_rays(fullscreen_samples(view_spec))
+
+        r, g, b = renderer.render_from_rays(voxel_access, clamping_function=ClampingFunctions.CLAMP)
+        ray_by_ray = renderer.render_serial(voxel_access, camera, ClampingFunctions.CLAMP)
+        self.assertTrue(torch.allclose(ray_by_ray[:, [0, 1, 2]].float(), r, atol=1e-5))
+        self.assertTrue(torch.allclose(ray_by_ray[:, [0, 1, 3]].float(), g, atol=1e-5))
+        self.assertTrue(torch.allclose(ray_by_ray[:, [0, 1, 4]].float(), b, atol=1e-5))
+
+    def test_renders_full_image_headless(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.4, 0.4, -0.3, 0.3, 5, 4])
+        renderer = Renderer(world, camera, view_spec, torch.tensor([20, 41]))
+
+        red, green, blue = renderer.render()
+        r, _, _ = renderer.render_from_rays(renderer.build_rays(fullscreen_samples(view_spec)))
+
+        self.assertEqual((4, 5), red.shape)
+        self.assertEqual((4, 5), blue.shape)
+        # The top row of the image is the highest view point
+        for x, y, intensity in r.detach():
+            column, row = round((float(x) + 0.4) / 0.2), 3 - round((float(y) + 0.3) / 0.2)
+            self.assertAlmostEqual(float(intensity), float(red[row, column]), places=5)
+
+    def test_render_pool_renders_same_image_as_single_process(self):
+        world = VoxelGrid.build_random_world(4, 4, 4)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        renderer = Renderer(world, camera, torch.tensor([-0.4, 0.4, -0.3, 0.3, 5, 4]), torch.tensor([20, 41]))
+
+        with RenderPool(world, num_workers=2, tile_size=3) as render_pool:
+            pooled_image = renderer.render(render_pool=render_pool)
+        for pooled_channel, channel in zip(pooled_image, renderer.render()):
+            self.assertTrue(torch.allclose(channel, pooled_channel, atol=1e-6))
+
+    def test_scatters_samples_into_image_and_gathers_pixels_for_loss(self):
+        view_spec = torch.tensor([-1., 1., -1., 1., 2, 2])
+        red = torch.tensor([[-1., 1., 0.1], [0., 1., 0.2], [-1., 0., 0.3], [1., -1., 0.4]])
+        image = samples_to_image(red, red, red, view_spec)
+
+        # Pixels are written one row up and one column left of the pixel their view point maps to
+        self.assertTrue(torch.allclose(torch.tensor([[0.4, 0.3], [0.2, 0.1]]), image[0]))
+        true_channel = torch.tensor([[0.1, 0.2], [0.3, 0.4]])
+        self.assertTrue(torch.allclose(torch.tensor(0.), mse(red, true_channel, view_spec, error_histogram=True)))
+
+    def test_evaluates_harmonic_basis_for_batch_of_directions(self):
+        directions = torch.tensor([[1., 0., 0.], [0., 0., 1.]])
+        basis = SphericalHarmonics(2).basis(directions)
+        self.assertEqual((2, 9), basis.shape)
+        self.assertTrue(torch.allclose(torch.tensor([0.5 * math.sqrt(1. / math.pi), 0., 0.,
+                                                     0.5 * math.sqrt(3. / math.pi), 0., 0.,
+                                                     -0.25 * math.sqrt(5. / math.pi), 0.,
+                                                     0.25 * math.sqrt(15. / math.pi)]), basis[0]))
+        self.assertEqual((2, 1), SphericalHarmonics(0).basis(directions).shape)
+        self.assertEqual((2, 16), SphericalHarmonics(3).basis(directions).shape)
+
+    def test_colours_are_contraction_of_coefficients_with_basis(self):
+        harmonic_coefficients = torch.rand([5, 3, 9])
+        basis = torch.rand([5, 9])
+        colours = SphericalHarmonics.colours(harmonic_coefficients, basis)
+        self.assertEqual((5, 3), colours.shape)
+        self.assertTrue(torch.allclose((harmonic_coefficients * basis.unsqueeze(1)).sum(-1), colours))
+
+    def test_caches_harmonic_basis_per_camera_pose(self):
+        harmonics = SphericalHarmonics(2)
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        same_pose = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        self.assertIs(harmonics.basis_for_camera(camera), harmonics.basis_for_camera(same_pose))
+
+    def test_batched_interpolation_matches_interpolating_one_sample_at_a_time(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world_positions = torch.rand([20, 3]) * 3
+
+        interpolated = world.interpolate(world_positions)
+
+        self.assertEqual((20, VoxelGrid.VOXEL_DIMENSION), interpolated.shape)
+        for world_position, interpolated_voxel in zip(world_positions, interpolated):
+            neighbours, _ = world.neighbours(*world_position)
+            self.assertTrue(torch.allclose(world.intensities(world_position, neighbours), interpolated_voxel,
+                                           atol=1e-6))
+
+    def test_batched_interpolation_is_differentiable_with_respect_to_grid(self):
+        model = PlenoxelModel(VoxelGrid.build_random_world(3, 3, 3))
+        model.world().interpolate(torch.tensor([[0.5, 0.5, 0.5]])).sum().backward()
+        self.assertTrue(torch.allclose(torch.full([VoxelGrid.VOXEL_DIMENSION], 0.125), model.voxel_grid.grad[1, 1, 1]))
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ZEROES, model.voxel_grid.grad[2, 2, 2]))
+
+    def test_total_variation_from_shifted_differences(self):
+        world = VoxelGrid.build_random_world(2, 3, 4)
+        voxel = world.voxel_by_position(1, 1, 2)
+        delta_x = (voxel / (256 / 2)).pow(2)
+        delta_y = ((voxel - world.voxel_by_position(1, 2, 2)) / (256 / 3)).pow(2)
+        delta_z = ((voxel - world.voxel_by_position(1, 1, 3)) / (256 / 4)).pow(2)
+        expected_tv = (delta_x + delta_y + delta_z + 0.0001).sqrt().sum()
+
+        self.assertTrue(torch.allclose(expected_tv, tv_at(world, torch.tensor([[1, 1, 2]]))))
+        all_voxel_positions = torch.stack(torch.meshgrid(torch.arange(2), torch.arange(3), torch.arange(4),
+                                                         indexing="ij"), -1).reshape(-1, 3)
+        self.assertTrue(torch.allclose(tv_at(world, all_voxel_positions), tv_over_grid(world)))
+
+    def test_cauchy_term_over_distinct_voxels_matches_every_touch(self):
+        model = PlenoxelModel(VoxelGrid.build_random_world(4, 4, 4))
+        camera = Camera(2, torch.tensor([2., 2., -10., 1.]), torch.tensor([2., 2., 2., 1.]))
+        view_spec = torch.tensor([-0.3, 0.3, -0.3, 0.3, 5, 5])
+        renderer = Renderer(model.world(), camera, view_spec, torch.tensor([20, 41]))
+        voxel_access = renderer.build_rays(fullscreen_samples(view_spec))
+
+        every_touch = model.world().voxels_at(voxel_access.all_voxel_positions())[:, 0]
+        expected_cauchy = torch.log(1 + 2 * every_touch.pow(2)).sum()
+        expected_gradient, = torch.autograd.grad(expected_cauchy, model.voxel_grid)
+        cauchy = cauchy_term(voxel_access, model.world())
+        gradient, = torch.autograd.grad(cauchy, model.voxel_grid)
+
+        self.assertTrue(torch.allclose(expected_cauchy, cauchy))
+        self.assertTrue(torch.allclose(expected_gradient, gradient))
+
+    def test_finds_distinct_voxel_positions_through_flat_indices(self):
+        world = VoxelGrid.build_empty_world(3, 4, 5)
+        voxel_positions = torch.tensor([[2, 3, 4], [0, 1, 2], [2, 3, 4], [1, 0, 0], [0, 1, 2], [2, 3, 4]])
+        distinct_positions, counts = world.distinct_voxel_positions(voxel_positions)
+        expected_positions, expected_counts = torch.unique(voxel_positions, dim=0, return_counts=True)
+        self.assertTrue(torch.equal(expected_positions, distinct_positions))
+        self.assertTrue(torch.equal(expected_counts, counts))
+
+    def test_debug_capture_is_bounded_and_opt_in(self):
+        parameter = torch.ones(3, requires_grad=True)
+        DebugCapture.record("samples", parameter * 2)
+        with DebugCapture(capacity=2) as capture:
+            for i in range(3):
+                DebugCapture.record("samples", parameter * i)
+        DebugCapture.record("samples", parameter * 3)
+
+        captured = capture.captured("samples")
+        self.assertEqual(2, len(captured))
+        self.assertTrue(torch.equal(torch.ones(3) * 2, captured[-1]))
+        self.assertFalse(captured[-1].requires_grad)
+        self.assertIsNone(DebugCapture.ACTIVE)
+
+    def test_sparse_world_stores_only_unpruned_voxels(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world.set_pruned((0, 0, 0))
+        world.set_pruned((2, 1, 0))
+        sparse_world = SparseVoxelGrid.from_dense(world)
+
+        self.assertEqual((26, VoxelGrid.VOXEL_DIMENSION), sparse_world.features.shape)
+        self.assertTrue(torch.equal(world.voxel_grid, sparse_world.to_dense().voxel_grid))
+        self.check_pruned(sparse_world.voxel_by_position(2, 1, 0))
+        self.assertTrue(torch.equal(world.voxel_by_position(1, 2, 1), sparse_world.voxel_by_position(1, 2, 1)))
+        voxel_positions = torch.tensor([[0, 0, 0], [1, 1, 1], [3, 0, 0], [-1, 2, 2]])
+        self.assertTrue(torch.equal(world.voxels_at(voxel_positions), sparse_world.voxels_at(voxel_positions)))
+
+        sparse_world.set_pruned((1, 1, 1))
+        self.assertEqual((25, VoxelGrid.VOXEL_DIMENSION), sparse_world.compacted().features.shape)
+
+    def test_sparse_world_interpolates_and_scales_up_like_dense_world(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world.set_pruned((1, 1, 1))
+        sparse_world = SparseVoxelGrid.from_dense(world)
+        world_positions = torch.rand([20, 3]) * 3.5
+
+        self.assertTrue(torch.allclose(world.interpolate(world_positions), sparse_world.interpolate(world_positions)))
+        self.assertTrue(torch.equal(world.scale_up().voxel_grid, sparse_world.scale_up().to_dense().voxel_grid))
+        self.assertTrue(torch.equal(world.occupancy_grid(), sparse_world.occupancy_grid()))
+
+        trilinear_world = world.scale_up(mode="trilinear")
+        sparse_trilinear_world = sparse_world.scale_up(mode="trilinear")
+        self.assertTrue(torch.equal(trilinear_world.pruned, sparse_trilinear_world.pruned))
+        self.assertTrue(torch.allclose(trilinear_world.voxel_grid, sparse_trilinear_world.to_dense().voxel_grid,
+                                       atol=1e-6))
+
+    def test_grid_regularisation_of_sparse_world_never_builds_dense_grid(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world.set_pruned((1, 1, 1))
+        sparse_world = SparseVoxelGrid.from_dense(world)
+
+        self.assertTrue(torch.allclose(cauchy_term(None, world, mode="grid"),
+                                       cauchy_term(None, sparse_world, mode="grid")))
+        with self.assertRaises(ValueError):
+            tv_over_grid(sparse_world)
+
+    def test_model_trains_sparse_world_through_feature_table(self):
+        world = VoxelGrid.build_random_world(3, 3, 3)
+        world.set_pruned((1, 1, 1))
+        model = PlenoxelModel(SparseVoxelGrid.from_dense(world))
+        self.assertIn("links", model.state_dict())
+
+        model.world().interpolate(torch.tensor([[1.5, 1.5, 1.5], [0.5, 0.5, 0.5]])).sum().backward()
+        pruned_row = int(model.world().links[1, 1, 1])
+        trained_row = int(model.world().links[0, 0, 0])
+        self.assertEqual(SparseVoxelGrid.EMPTY_ROW, pruned_row)
+        self.assertTrue(torch.equal(PlenoxelTest.ALL_ZEROES, model.voxel_grid.grad[SparseVoxelGrid.EMPTY_ROW]))
+        self.assertTrue(torch.allclose(torch.full([VoxelGrid.VOXEL_DIMENSION], 0.125),
+                                       model.voxel_grid.grad[trained_row]))
+
+        model.prune(torch.ones([3, 3, 3], dtype=torch.bool))
+        self.assertFalse(model.world().occupancy_grid().any())
 
     def test_can_copy_from_another_world(self):
         original_world = VoxelGrid.build_random_world(5, 5, 5)
@@ -1,11 +1,16 @@
-import functools
+import hashlib
+import json
 import math
+import queue
 import random
+import threading
+from collections import deque
 import matplotlib.pyplot as plt
 from matplotlib import use as mpl_use
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import pathos.multiprocessing as mp
 import torch.multiprocessing as tmp
 from timeit import default_timer as timer
@@ -146,16 +151,69 @@ GRID_Z = 50
 
 INHOMOGENEOUS_ZERO_VECTOR = torch.tensor([0., 0., 0.])
 REGULARISATION_FRACTION = 0.01
+TV_EPSILON = 0.0001
 TV_REGULARISATION_LAMBDA = 0.001
 CAUCHY_REGULARISATION_LAMBDA = 0.001
 LEARNING_RATE = 0.0005
 NUM_STOCHASTIC_RAYS = 1500
+# Optimiser steps per epoch when training on stochastic rays drawn across all training views
+RAY_BATCHES_PER_EPOCH = 100
 ARBITRARY_SCALE = 5
+SPHERICAL_HARMONIC_DEGREE = 2
 
-MASTER_RAY_SAMPLE_POSITIONS_STRUCTURE = []
-MASTER_VOXELS_STRUCTURE = []
-VOXELS_NOT_USED = 0
 OUTPUT_FOLDER = "./output"
+DEFAULT_DEBUG_CAPTURE_CAPACITY = 1000
+# Rays stop being composited once less than this much light can get through to the remaining samples
+EARLY_TERMINATION_TRANSMITTANCE = 1e-3
+# Redistributed samples are pulled this far inside the grid, so that the end points do not fall on its faces
+RAY_BOX_EPSILON = 1e-4
+# Ray geometry of the training cameras is kept here between training runs
+RAY_STORE_FOLDER = f"{OUTPUT_FOLDER}/ray-geometry"
+CUBE_TRAINING_FOLDER = "./images/cube"
+TABLE_TRAINING_FOLDER = "./images/table/small-png"
+# Decoded training images are kept here between training runs
+TRAINING_IMAGE_CACHE_FOLDER = f"{OUTPUT_FOLDER}/training-images"
+# Number of training views whose rays are drawn together in one step when training from a view manifest
+VIEWS_PER_BATCH = 8
+
+
+# Opt-in capture of intermediate tensors for debugging, replacing ever-growing global lists.
+# Captures are bounded ring buffers of detached tensors, so they neither grow across epochs
+# nor keep autograd graphs alive. Nothing is captured unless a capture is active; callers whose
+# captured tensor is costly to build check DebugCapture.ACTIVE first, so that it is not built at all:
+#
+#   with DebugCapture(capacity=100, sampling_fraction=0.1) as capture:
+#       renderer.render(plt)
+#   capture.captured("ray_sample_positions")
+class DebugCapture:
+    ACTIVE = None
+
+    def __init__(self, capacity=DEFAULT_DEBUG_CAPTURE_CAPACITY, sampling_fraction=1.):
+        self.capacity = capacity
+        self.sampling_fraction = sampling_fraction
+        self.buffers = {}
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = DebugCapture.ACTIVE
+        DebugCapture.ACTIVE = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        DebugCapture.ACTIVE = self.previous
+
+    def captured(self, name):
+        return list(self.buffers.get(name, []))
+
+    def capture(self, name, tensor):
+        if self.sampling_fraction < 1. and random.random() >= self.sampling_fraction:
+            return
+        self.buffers.setdefault(name, deque(maxlen=self.capacity)).append(tensor.detach())
+
+    @staticmethod
+    def record(name, tensor):
+        if DebugCapture.ACTIVE is not None:
+            DebugCapture.ACTIVE.capture(name, tensor)
 
 
 class Camera:
@@ -253,36 +311,81 @@ def generate_camera_angles(radius, look_at):
     return positions
 
 
+HALF_SQRT_1_BY_PI = 0.5 * math.sqrt(1. / math.pi)
 HALF_SQRT_3_BY_PI = 0.5 * math.sqrt(3. / math.pi)
 HALF_SQRT_15_BY_PI = 0.5 * math.sqrt(15. / math.pi)
 QUARTER_SQRT_15_BY_PI = 0.25 * math.sqrt(15. / math.pi)
 QUARTER_SQRT_5_BY_PI = 0.25 * math.sqrt(5. / math.pi)
+QUARTER_SQRT_35_BY_2_PI = 0.25 * math.sqrt(35. / (2 * math.pi))
+HALF_SQRT_105_BY_PI = 0.5 * math.sqrt(105. / math.pi)
+QUARTER_SQRT_21_BY_2_PI = 0.25 * math.sqrt(21. / (2 * math.pi))
+QUARTER_SQRT_7_BY_PI = 0.25 * math.sqrt(7. / math.pi)
+QUARTER_SQRT_105_BY_PI = 0.25 * math.sqrt(105. / math.pi)
+
+
+# Real spherical harmonics up to degree 3, evaluated for a whole batch of directions at once.
+# The viewing angle is constant for a camera, so the basis is cached per camera pose.
+class SphericalHarmonics:
+    MAX_DEGREE = 3
 
-Y_0_0 = 0.5 * math.sqrt(1. / math.pi)
-Y_m1_1 = lambda theta, phi: HALF_SQRT_3_BY_PI * math.sin(theta) * math.sin(phi)
-Y_0_1 = lambda theta, phi: HALF_SQRT_3_BY_PI * math.cos(theta)
-Y_1_1 = lambda theta, phi: HALF_SQRT_3_BY_PI * math.sin(theta) * math.cos(phi)
-Y_m2_2 = lambda theta, phi: HALF_SQRT_15_BY_PI * math.sin(theta) * math.cos(phi) * math.sin(
-    theta) * math.sin(phi)
-Y_m1_2 = lambda theta, phi: HALF_SQRT_15_BY_PI * math.sin(theta) * math.sin(phi) * math.cos(theta)
-Y_0_2 = lambda theta, phi: QUARTER_SQRT_5_BY_PI * (3 * math.cos(theta) * math.cos(theta) - 1)
-Y_1_2 = lambda theta, phi: HALF_SQRT_15_BY_PI * math.sin(theta) * math.cos(phi) * math.cos(theta)
-Y_2_2 = lambda theta, phi: QUARTER_SQRT_15_BY_PI * (
-        pow(math.sin(theta) * math.cos(phi), 2) - pow(math.sin(theta) * math.sin(phi), 2))
+    def __init__(self, degree):
+        if degree < 0 or degree > SphericalHarmonics.MAX_DEGREE:
+            raise ValueError(f"Spherical harmonics of degree {degree} are not supported")
+        self.degree = degree
+        self.camera_basis_cache = {}
 
+    def num_basis_functions(self):
+        return (self.degree + 1) ** 2
 
-def harmonic(C_0_0, C_m1_1, C_0_1, C_1_1, C_m2_2, C_m1_2, C_0_2, C_1_2, C_2_2):
-    return lambda theta, phi: C_0_0 * Y_0_0 + C_m1_1 * Y_m1_1(theta, phi) + C_0_1 * Y_0_1(theta, phi) + C_1_1 * Y_1_1(
-        theta, phi) + C_m2_2 * Y_m2_2(theta, phi) + C_m1_2 * Y_m1_2(theta, phi) + C_0_2 * Y_0_2(theta,
-                                                                                                phi) + C_1_2 * Y_1_2(
-        theta, phi) + C_2_2 * Y_2_2(theta, phi)
+    @staticmethod
+    def directions_from_angles(viewing_angles):
+        theta, phi = viewing_angles[..., 0], viewing_angles[..., 1]
+        return torch.stack([torch.sin(theta) * torch.cos(phi),
+                            torch.sin(theta) * torch.sin(phi),
+                            torch.cos(theta)], -1)
+
+    # Takes (..., 3) unit directions, returns the (..., (degree + 1)^2) basis matrix,
+    # ordered by degree, and by order from -l to l within a degree
+    def basis(self, directions):
+        x, y, z = directions[..., 0], directions[..., 1], directions[..., 2]
+        basis_functions = [torch.full_like(x, HALF_SQRT_1_BY_PI)]
+        if self.degree >= 1:
+            basis_functions += [HALF_SQRT_3_BY_PI * y,
+                                HALF_SQRT_3_BY_PI * z,
+                                HALF_SQRT_3_BY_PI * x]
+        if self.degree >= 2:
+            basis_functions += [HALF_SQRT_15_BY_PI * x * y,
+                                HALF_SQRT_15_BY_PI * y * z,
+                                QUARTER_SQRT_5_BY_PI * (3 * z * z - 1),
+                                HALF_SQRT_15_BY_PI * x * z,
+                                QUARTER_SQRT_15_BY_PI * (x * x - y * y)]
+        if self.degree >= 3:
+            basis_functions += [QUARTER_SQRT_35_BY_2_PI * y * (3 * x * x - y * y),
+                                HALF_SQRT_105_BY_PI * x * y * z,
+                                QUARTER_SQRT_21_BY_2_PI * y * (5 * z * z - 1),
+                                QUARTER_SQRT_7_BY_PI * z * (5 * z * z - 3),
+                                QUARTER_SQRT_21_BY_2_PI * x * (5 * z * z - 1),
+                                QUARTER_SQRT_105_BY_PI * z * (x * x - y * y),
+                                QUARTER_SQRT_35_BY_2_PI * x * (x * x - 3 * y * y)]
+        return torch.stack(basis_functions, -1)
+
+    def basis_from_angles(self, viewing_angles):
+        return self.basis(SphericalHarmonics.directions_from_angles(viewing_angles))
+
+    def basis_for_camera(self, camera):
+        pose = (tuple(camera.center.tolist()), tuple(camera.look_at.tolist()))
+        if pose not in self.camera_basis_cache:
+            self.camera_basis_cache[pose] = self.basis_from_angles(camera.viewing_angle())
+        return self.camera_basis_cache[pose]
+
+    # Contracts (..., 3, K) RGB coefficients with a (..., K) basis which broadcasts against them,
+    # giving (..., 3) colours
+    @staticmethod
+    def colours(harmonic_coefficients, basis):
+        return torch.matmul(harmonic_coefficients, basis.unsqueeze(-1)).squeeze(-1)
 
 
-def rgb_harmonics(rgb_harmonic_coefficients):
-    red_harmonic = harmonic(*rgb_harmonic_coefficients[:9])
-    green_harmonic = harmonic(*rgb_harmonic_coefficients[9:18])
-    blue_harmonic = harmonic(*rgb_harmonic_coefficients[18:])
-    return (red_harmonic, green_harmonic, blue_harmonic)
+SPHERICAL_HARMONICS = SphericalHarmonics(SPHERICAL_HARMONIC_DEGREE)
 
 
 class Voxel:
@@ -292,47 +395,42 @@ class Voxel:
     NUM_VOXEL_NEIGHBOURS = 9 * 3 - 1
     VOXEL_PRUNING_NEIGHBOUR_OPACITY_THRESHOLDS = torch.full([NUM_VOXEL_NEIGHBOURS], VOXEL_PRUNING_OPACITY_THRESHOLD)
 
+    # Voxel factories take an optional grid shape, so that a whole grid can be generated in one call:
+    # make_voxel() returns a single voxel, make_voxel(x, y, z) returns an (x, y, z, VOXEL_DIMENSION) tensor
     @staticmethod
-    def default_voxel(requires_grad=True):
-        return lambda: torch.tensor(Voxel.uniform_harmonic(), requires_grad=requires_grad)
+    def default_voxel():
+        return lambda *shape: torch.tensor(Voxel.uniform_harmonic()).repeat(*shape, 1)
 
     @staticmethod
-    def random_coloured_voxel(requires_grad=True):
-        return lambda: torch.tensor(
-            np.concatenate(([0.7], (np.random.rand(VoxelGrid.VOXEL_DIMENSION - 1) - 0.5))),
-            requires_grad=requires_grad)
+    def random_coloured_voxel():
+        return lambda *shape: torch.cat([torch.full([*shape, 1], 0.7),
+                                         torch.rand([*shape, VoxelGrid.VOXEL_DIMENSION - 1]) - 0.5], -1)
 
     @staticmethod
     def uniform_harmonic(density=1.):
         return [density] + ([0.5] + [0.] * (VoxelGrid.PER_CHANNEL_DIMENSION - 1)) * 3
 
     @staticmethod
-    def random_harmonic_coefficient_set():
-        return ([random.random()] + [0.] * (VoxelGrid.PER_CHANNEL_DIMENSION - 1))
+    def uniform_harmonic_random_colour(density=0.04):
+        def make_voxel(*shape):
+            voxel = torch.zeros([*shape, VoxelGrid.VOXEL_DIMENSION])
+            voxel[..., 0] = density
+            voxel[..., 1::VoxelGrid.PER_CHANNEL_DIMENSION] = torch.rand([*shape, 3])
+            return voxel
 
-    @staticmethod
-    def uniform_harmonic_random_colour(density=0.04, requires_grad=True):
-        return lambda: torch.tensor([
-                                        density] + Voxel.random_harmonic_coefficient_set() + Voxel.random_harmonic_coefficient_set() + Voxel.random_harmonic_coefficient_set(),
-                                    requires_grad=requires_grad)
+        return make_voxel
 
     @staticmethod
-    def occupied_voxel(density=1., requires_grad=True):
-        return lambda: torch.tensor(Voxel.uniform_harmonic(density), requires_grad=requires_grad)
+    def occupied_voxel(density=1.):
+        return lambda *shape: torch.tensor(Voxel.uniform_harmonic(density)).repeat(*shape, 1)
 
     @staticmethod
-    def empty_voxel(requires_grad=True):
-        return lambda: torch.zeros([VoxelGrid.VOXEL_DIMENSION], requires_grad=requires_grad)
+    def empty_voxel():
+        return lambda *shape: torch.zeros([*shape, VoxelGrid.VOXEL_DIMENSION])
 
     @staticmethod
     def like_voxel(prototype_voxel):
-        return lambda: prototype_voxel.clone()
-
-    @staticmethod
-    def prune(voxel_tensor):
-        voxel_tensor.requires_grad = False
-        voxel_tensor.fill_(0.)
-        voxel_tensor.pruned = True
+        return lambda *shape: prototype_voxel.detach().float().repeat(*shape, 1)
 
     @staticmethod
     def is_pruned(voxel_tensor):
@@ -340,14 +438,13 @@ class Voxel:
 
 
 class Ray:
-    def __init__(self, num_samples, view_point, ray_sample_positions, voxel_positions, voxels):
+    def __init__(self, num_samples, view_point, ray_sample_positions, ray_sample_distances, voxel_positions, voxels):
         self.num_samples = num_samples
         self.ray_sample_positions = ray_sample_positions
+        self.ray_sample_distances = ray_sample_distances
         self.view_point = view_point
         self.voxels = voxels
         self.voxel_positions = voxel_positions
-        if num_samples != len(ray_sample_positions):
-            log.warning(f"WARNING: num_samples = {num_samples}, sample_positions = {ray_sample_positions}")
 
     def at(self, index):
         start = index * Voxel.NUM_INTERPOLATING_VOXEL_NEIGHBOURS
@@ -357,22 +454,66 @@ class Ray:
                self.voxels[start: end]
 
 
+# Holds only the geometry of a batch of rays, as padded (num_rays, num_samples, ...) tensors.
+# Samples are left-aligned along each ray; sample_mask marks the samples which are composited,
+# i.e., the samples inside the grid which have a following sample inside the grid.
+# Voxel values are not stored here, they are gathered from the world using voxel_positions.
+# interpolating_weights are the trilinear weights of the 8 corners in voxel_positions for every sample. They
+# are optional; if they are absent, they are computed from ray_sample_positions when the grid is read.
+# ray_indices, if present, are the positions of these rays among the rays they were built from.
 class VoxelAccess:
-    def __init__(self, view_points, ray_sample_positions, voxel_pointers, all_voxels, all_voxel_positions):
-        self.ray_sample_positions = ray_sample_positions
+    def __init__(self, view_points, ray_sample_positions, ray_sample_distances, sample_mask, voxel_positions,
+                 interpolating_weights=None, ray_indices=None):
         self.view_points = view_points
-        self.voxel_positions = all_voxel_positions
-        self.all_voxels = all_voxels
-        self.voxel_pointers = voxel_pointers
-
-    def for_ray(self, ray_index):
-        ptr = self.voxel_pointers[ray_index]
-        start, end, num_samples = ptr
+        self.ray_sample_positions = ray_sample_positions
+        self.ray_sample_distances = ray_sample_distances
+        self.sample_mask = sample_mask
+        self.voxel_positions = voxel_positions
+        self.interpolating_weights = interpolating_weights
+        self.ray_indices = ray_indices
+
+    def num_rays(self):
+        return len(self.view_points)
+
+    def all_voxel_positions(self):
+        return self.voxel_positions[self.sample_mask].reshape(-1, 3)
+
+    # Keeps only the samples selected by sample_mask, compacted to the front of every ray
+    def compacted(self, sample_mask):
+        sample_tensors = [self.ray_sample_positions, self.ray_sample_distances, self.voxel_positions]
+        if (self.interpolating_weights is not None):
+            sample_tensors.append(self.interpolating_weights)
+        sample_mask, ray_sample_positions, ray_sample_distances, voxel_positions, *compacted_weights = \
+            compact_samples(sample_mask, *sample_tensors)
+        interpolating_weights = compacted_weights[0] if compacted_weights else None
+        return VoxelAccess(self.view_points, ray_sample_positions, ray_sample_distances, sample_mask,
+                           voxel_positions, interpolating_weights, self.ray_indices)
+
+    def for_ray(self, ray_index, world):
+        num_samples = int(self.sample_mask[ray_index].sum())
+        voxel_positions = self.voxel_positions[ray_index, :num_samples].reshape(-1, 3)
         return Ray(num_samples, self.view_points[ray_index],
-                   self.ray_sample_positions[int(start / Voxel.NUM_INTERPOLATING_VOXEL_NEIGHBOURS): int(
-                       end / Voxel.NUM_INTERPOLATING_VOXEL_NEIGHBOURS)],
-                   self.voxel_positions[start:end],
-                   self.all_voxels[start:end])
+                   self.ray_sample_positions[ray_index, :num_samples],
+                   self.ray_sample_distances[ray_index, :num_samples],
+                   voxel_positions,
+                   world.voxels_at(voxel_positions))
+
+
+# Moves the selected samples of every ray to the front, preserving their order along the ray,
+# and trims the sample dimension to the longest selection. Unselected slots are zeroed.
+def compact_samples(sample_mask, *sample_tensors):
+    num_rays = len(sample_mask)
+    num_selected = sample_mask.sum(1)
+    max_selected = int(num_selected.max()) if num_rays > 0 else 0
+    order = torch.sort((~sample_mask).int(), dim=1, stable=True).indices[:, :max_selected]
+    compacted_mask = torch.arange(max_selected).unsqueeze(0) < num_selected.unsqueeze(1)
+    ray_indices = torch.arange(num_rays).unsqueeze(1)
+    compacted_tensors = []
+    for sample_tensor in sample_tensors:
+        compacted = sample_tensor[ray_indices, order]
+        mask = compacted_mask.reshape(compacted_mask.shape + (1,) * (compacted.dim() - 2))
+        compacted_tensors.append(torch.where(mask, compacted, torch.zeros_like(compacted)))
+    return (compacted_mask, *compacted_tensors)
 
 
 def cube_faces(cube_spec):
@@ -387,15 +528,27 @@ def cube_faces(cube_spec):
 
 
 class VoxelGrid:
-    VOXEL_DIMENSION = 28
-    PER_CHANNEL_DIMENSION = 9
+    PER_CHANNEL_DIMENSION = (SPHERICAL_HARMONIC_DEGREE + 1) ** 2
+    VOXEL_DIMENSION = 1 + 3 * PER_CHANNEL_DIMENSION
     DEFAULT_SCALE = torch.tensor([1., 1., 1.])
-
-    def __init__(self, world_tensor, scale=DEFAULT_SCALE):
+    # Offsets of the 8 interpolating neighbours, in the order c_000, c_001, c_010, ..., c_111
+    INTERPOLATING_NEIGHBOUR_OFFSETS = torch.tensor([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+                                                    [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]])
+    # Edge length, in voxels, of the cells of the coarse occupancy grid
+    OCCUPANCY_CELL_SIZE = 4
+
+    # The grid is stored as a single contiguous (X, Y, Z, VOXEL_DIMENSION) tensor.
+    # Pruned voxels are tracked in a separate boolean (X, Y, Z) mask, since individual
+    # voxels are now views into the grid and cannot carry their own attributes.
+    def __init__(self, world_tensor, scale=DEFAULT_SCALE, pruned=None):
         self.scale = scale
-        self.grid_x, self.grid_y, self.grid_z = torch.tensor(world_tensor.shape) * self.scale
-        self.voxel_grid_x, self.voxel_grid_y, self.voxel_grid_z = world_tensor.shape
+        self.grid_x, self.grid_y, self.grid_z = torch.tensor(world_tensor.shape[:3]) * self.scale
+        self.voxel_grid_x, self.voxel_grid_y, self.voxel_grid_z = world_tensor.shape[:3]
         self.voxel_grid = world_tensor
+        self.pruned = pruned if pruned is not None else torch.zeros(world_tensor.shape[:3], dtype=torch.bool)
+        self.activated = None
+        self.occupancy = None
+        self.occupancy_key = None
 
     def voxel_dimensions(self):
         return torch.tensor([self.voxel_grid_x, self.voxel_grid_y, self.voxel_grid_z]).int()
@@ -423,61 +576,59 @@ class VoxelGrid:
 
     @staticmethod
     def copy_from(world, scale=DEFAULT_SCALE):
-        return VoxelGrid(world.voxel_grid.copy(), scale=world.scale)
+        return VoxelGrid(world.voxel_grid.detach().clone(), scale=world.scale, pruned=world.pruned.clone())
 
     @classmethod
     def from_tensor(cls, world_tensor, scale=DEFAULT_SCALE):
         return cls(world_tensor, scale)
 
-    @classmethod
-    def as_parameter(cls, world, model):
-        world_tensor = world.voxel_grid
-        voxel_x, voxel_y, voxel_z = world.voxel_dimensions()
-        new_world = VoxelGrid.build_empty_world(voxel_x, voxel_y, voxel_z, scale=world.scale)
-        for i, j, k, v in world.all_voxels():
-            parameter = nn.Parameter(v)
-            if Voxel.is_pruned(v):
-                Voxel.prune(parameter)
-            new_world.set((i, j, k), parameter)
-            model.register_parameter(f"{(i, j, k)}", parameter)
-        return new_world
-
     @classmethod
     def new(cls, voxel_x, voxel_y, voxel_z, make_voxel, scale=DEFAULT_SCALE):
         log.info(f"Initialising world with dimensions ({voxel_x, voxel_y, voxel_z})")
-        voxel_grid = np.ndarray((voxel_x, voxel_y, voxel_z), dtype=list)
-        for i in range(voxel_x):
-            for j in range(voxel_y):
-                for k in range(voxel_z):
-                    voxel_grid[i, j, k] = make_voxel()
+        voxel_grid = make_voxel(int(voxel_x), int(voxel_y), int(voxel_z)).float().contiguous()
         return cls(voxel_grid, scale)
 
     def at(self, world_x, world_y, world_z):
         if self.is_outside(world_x, world_y, world_z):
-            return Voxel.empty_voxel(requires_grad=False)()
+            return Voxel.empty_voxel()()
         else:
             voxel_x, voxel_y, voxel_z = self.to_voxel_coordinates(torch.tensor([world_x, world_y, world_z]))
-            return self.voxel_grid[voxel_x, voxel_y, voxel_z]
-
-    # TODO: Remember to test scale_up() again
-    def scale_up(self):
-        new_dimensions = self.voxel_dimensions() * 2
+            return self.voxel_by_position(voxel_x, voxel_y, voxel_z)
+
+    # Doubles the resolution of the grid in every dimension.
+    # "nearest" copies every voxel into its 8 children, which inherit its pruning.
+    # "trilinear" puts the new voxels on and halfway between the old ones, with the values the renderer
+    # would interpolate there. Trilinear interpolation restricted to a child cell is itself trilinear,
+    # so the upsampled world renders exactly like the original. A child is pruned only if every voxel
+    # it is interpolated from is pruned.
+    def scale_up(self, mode="nearest"):
         new_scale = self.scale / 2
-        x_scale, y_scale, z_scale = new_scale
-        log.info(f"New scaled up dimensions={new_dimensions}")
-        scaled_up_world = VoxelGrid.build_empty_world(new_dimensions[0], new_dimensions[1], new_dimensions[2],
-                                                      scale=new_scale)
-        for i, j, k, original_voxel in self.voxels_in_world(
-                torch.tensor([0, 0, 0, self.grid_x, self.grid_y, self.grid_z])):
-            x2 = (i * 2 + 1 / x_scale).int()
-            y2 = (j * 2 + 1 / y_scale).int()
-            z2 = (k * 2 + 1 / z_scale).int()
-            scaled_up_world.voxel_grid[i * 2: x2, j * 2: y2, k * 2: z2].fill(original_voxel.detach().clone())
-            if hasattr(original_voxel, "pruned"):
-                for x, y, z, v in scaled_up_world.voxel_by_position(
-                        torch.tensor([i * 2, j * 2, k * 2, 1 / x_scale, 1 / y_scale, 1 / z_scale])):
-                    Voxel.prune(v)
-        return scaled_up_world
+        log.info(f"New scaled up dimensions={self.voxel_dimensions() * 2}")
+        if mode == "nearest":
+            scaled_up_grid = VoxelGrid.upsample_nearest(self.voxel_grid.detach())
+            scaled_up_pruned = VoxelGrid.upsample_nearest(self.pruned.unsqueeze(-1).float())[..., 0] > 0.5
+        elif mode == "trilinear":
+            scaled_up_grid = VoxelGrid.upsample_trilinear(self.voxel_grid.detach())
+            scaled_up_pruned = VoxelGrid.upsample_trilinear((~self.pruned).unsqueeze(-1).float())[..., 0] == 0
+        else:
+            raise ValueError(f"Upsampling mode {mode} is not supported")
+        return VoxelGrid(scaled_up_grid.contiguous(), scale=new_scale, pruned=scaled_up_pruned.contiguous())
+
+    @staticmethod
+    def upsample_nearest(voxel_tensor):
+        channels_first = voxel_tensor.permute(3, 0, 1, 2).unsqueeze(0)
+        return F.interpolate(channels_first, scale_factor=2, mode="nearest")[0].permute(1, 2, 3, 0)
+
+    # Voxel i sits at coordinate i, and the grid reads as empty past its upper faces, so the grid is
+    # padded with one layer of empty voxels on the high side. Resampling the padded N + 1 voxels onto
+    # 2N + 1 with aligned corners puts new voxel j exactly at old coordinate j / 2.
+    @staticmethod
+    def upsample_trilinear(voxel_tensor):
+        channels_first = F.pad(voxel_tensor.permute(3, 0, 1, 2).unsqueeze(0), (0, 1, 0, 1, 0, 1))
+        voxel_x, voxel_y, voxel_z = voxel_tensor.shape[:3]
+        upsampled = F.interpolate(channels_first, size=(2 * voxel_x + 1, 2 * voxel_y + 1, 2 * voxel_z + 1),
+                                  mode="trilinear", align_corners=True)
+        return upsampled[0, :, :2 * voxel_x, :2 * voxel_y, :2 * voxel_z].permute(1, 2, 3, 0)
 
     def to_voxel_coordinates(self, world_coordinates):
         return torch.divide(world_coordinates, self.scale).int()
@@ -488,7 +639,68 @@ class VoxelGrid:
             log.warning(f"[WARNING]: set() attempted to set a value at {(voxel_position)} outside grid")
             return
         else:
-            self.voxel_grid[voxel_x, voxel_y, voxel_z] = voxel
+            with torch.no_grad():
+                self.voxel_grid[voxel_x, voxel_y, voxel_z] = voxel
+            self.pruned[voxel_x, voxel_y, voxel_z] = Voxel.is_pruned(voxel)
+
+    def set_pruned(self, voxel_position):
+        voxel_x, voxel_y, voxel_z = voxel_position
+        with torch.no_grad():
+            self.voxel_grid[voxel_x, voxel_y, voxel_z] = 0.
+        self.pruned[voxel_x, voxel_y, voxel_z] = True
+
+    # Prunes every voxel set in a boolean (X, Y, Z) mask
+    def prune_where(self, pruning_mask):
+        with torch.no_grad():
+            self.voxel_grid[pruning_mask] = 0.
+        self.pruned |= pruning_mask
+
+    # Density of every voxel, as an (X, Y, Z) tensor
+    def densities(self):
+        return self.voxel_grid[..., 0].detach()
+
+    # Densities of every stored voxel, differentiable with respect to the storage. Voxels which are not
+    # stored are empty, with zero density.
+    def stored_densities(self):
+        return self.voxel_grid[..., 0]
+
+    # Every voxel as an (X, Y, Z, VOXEL_DIMENSION) tensor, differentiable with respect to the storage.
+    # Sparse worlds do not materialise this, so modes which need it reject them.
+    def dense_voxels(self):
+        return self.voxel_grid
+
+    # Unpruned voxels which prune() would prune, computed over the whole grid at once: a voxel is prunable
+    # if neither it nor any of its 26 neighbours is above the pruning opacity threshold. Neighbours outside
+    # the grid count as empty, as in neighbour_opacities(). Pruning never makes another voxel prunable or
+    # unprunable, so this gives the same result as pruning voxel by voxel in any order.
+    def pruning_mask(self):
+        neighbourhood_densities = F.max_pool3d(self.densities().unsqueeze(0).unsqueeze(0), kernel_size=3, stride=1,
+                                               padding=1)[0, 0]
+        return (neighbourhood_densities <= Voxel.VOXEL_PRUNING_OPACITY_THRESHOLD) & ~self.pruned
+
+    # The tensor of trainable voxel values, and the tensors which index or qualify it. A world of
+    # the same kind can be rebuilt around replacements for these, which is how the model wraps
+    # its parameter and buffers, and how render workers share the grid.
+    def storage(self):
+        return self.voxel_grid
+
+    def buffers(self):
+        return {"pruned": self.pruned}
+
+    def with_storage(self, storage, buffers):
+        return VoxelGrid(storage, scale=self.scale, pruned=buffers["pruned"])
+
+    # Mask which zeroes the gradient of the storage wherever voxels are not trainable
+    def storage_gradient_mask(self):
+        return self.trainable().unsqueeze(-1)
+
+    def share_memory(self):
+        return self.with_storage(self.storage().detach().share_memory_(),
+                                 {name: buffer.share_memory_() for name, buffer in self.buffers().items()})
+
+    def trainable(self):
+        unpruned = ~self.pruned
+        return unpruned if self.activated is None else unpruned & self.activated
 
     def is_inside_grid(self, voxel_x, voxel_y, voxel_z):
         return (0 <= voxel_x < self.voxel_grid_x and
@@ -506,6 +718,75 @@ class VoxelGrid:
     def is_outside(self, world_x, world_y, world_z):
         return not self.is_inside(world_x, world_y, world_z)
 
+    def inside_grid_mask(self, voxel_positions):
+        return ((voxel_positions >= 0) & (voxel_positions < self.voxel_dimensions())).all(-1)
+
+    # The distinct voxel positions among a (N, 3) tensor of positions inside the grid, and how many times
+    # each occurs. Positions are flattened to (x * Y + y) * Z + z first, since a unique over single indices
+    # is much cheaper than a unique over rows of positions.
+    def distinct_voxel_positions(self, voxel_positions):
+        voxel_y, voxel_z = self.voxel_grid_y, self.voxel_grid_z
+        voxel_positions = voxel_positions.long()
+        flat_indices = (voxel_positions[:, 0] * voxel_y + voxel_positions[:, 1]) * voxel_z + voxel_positions[:, 2]
+        distinct_indices, counts = torch.unique(flat_indices, return_counts=True)
+        distinct_positions = torch.stack([distinct_indices // (voxel_y * voxel_z),
+                                          distinct_indices // voxel_z % voxel_y,
+                                          distinct_indices % voxel_z], -1)
+        return distinct_positions, counts
+
+    def inside_world_mask(self, world_positions):
+        world_dimensions = torch.stack([self.grid_x, self.grid_y, self.grid_z])
+        return ((world_positions >= 0) & (world_positions < world_dimensions)).all(-1)
+
+    # Coarse occupancy grid with one entry per OCCUPANCY_CELL_SIZE^3 cell of voxels. A cell is occupied
+    # if any sample inside it can interpolate an unpruned voxel, i.e. any voxel in the cell or one past
+    # its upper faces is unpruned. Pruned voxels are zero, so samples in unoccupied cells contribute
+    # nothing. The grid is rebuilt lazily whenever the pruned mask has been modified or replaced since it
+    # was built; a replacement mask can have the same version counter, so the mask's identity is checked too.
+    def occupancy_grid(self):
+        occupancy_key = (id(self.pruned), self.pruned._version)
+        if self.occupancy is not None and self.occupancy_key == occupancy_key:
+            return self.occupancy
+        unpruned = (~self.pruned).float().unsqueeze(0).unsqueeze(0)
+        interpolates_unpruned = F.max_pool3d(F.pad(unpruned, (0, 1, 0, 1, 0, 1)), kernel_size=2, stride=1)
+        self.occupancy = F.max_pool3d(interpolates_unpruned, kernel_size=VoxelGrid.OCCUPANCY_CELL_SIZE,
+                                      stride=VoxelGrid.OCCUPANCY_CELL_SIZE, ceil_mode=True)[0, 0] > 0
+        self.occupancy_key = occupancy_key
+        return self.occupancy
+
+    def occupied_mask(self, world_positions):
+        occupancy = self.occupancy_grid()
+        cells = self.to_voxel_coordinates(world_positions).long() // VoxelGrid.OCCUPANCY_CELL_SIZE
+        cells = torch.minimum(cells.clamp(min=0), torch.tensor(occupancy.shape) - 1)
+        return occupancy[cells[..., 0], cells[..., 1], cells[..., 2]]
+
+    # Slab-method intersection of rays with the bounds of the world. Returns the (t_near, t_far) distances
+    # along each ray between which it is inside the world; rays which miss the world have t_near > t_far.
+    def ray_intersections(self, ray_origins, ray_directions):
+        world_dimensions = torch.stack([self.grid_x, self.grid_y, self.grid_z]).float()
+        ray_origins = ray_origins.expand_as(ray_directions)
+        parallel = ray_directions == 0
+        safe_directions = torch.where(parallel, torch.ones_like(ray_directions), ray_directions)
+        t_lower = (0 - ray_origins) / safe_directions
+        t_upper = (world_dimensions - ray_origins) / safe_directions
+        t_entry = torch.minimum(t_lower, t_upper)
+        t_exit = torch.maximum(t_lower, t_upper)
+
+        # A ray parallel to a slab is either always inside it or never inside it
+        inside_slab = (ray_origins >= 0) & (ray_origins < world_dimensions)
+        t_entry = torch.where(parallel, torch.where(inside_slab, -math.inf, math.inf), t_entry)
+        t_exit = torch.where(parallel, torch.where(inside_slab, math.inf, -math.inf), t_exit)
+        return (t_entry.max(-1).values, t_exit.min(-1).values)
+
+    # Gathers the voxels at a (..., 3) tensor of voxel positions in one indexing operation.
+    # Positions outside the grid give empty voxels, like voxel_by_position().
+    def voxels_at(self, voxel_positions, channels=None):
+        voxel_grid = self.voxel_grid if channels is None else self.voxel_grid[..., channels]
+        inside = self.inside_grid_mask(voxel_positions)
+        clamped = torch.minimum(voxel_positions.clamp(min=0), self.voxel_dimensions().long() - 1)
+        voxels = voxel_grid[clamped[..., 0], clamped[..., 1], clamped[..., 2]]
+        return voxels * inside.unsqueeze(-1)
+
     def neighbour_opacities(self, voxel_x, voxel_y, voxel_z):
         opacities = []
         for i in range(voxel_x - 1, voxel_x + 2):
@@ -518,6 +799,8 @@ class VoxelGrid:
         return torch.stack(opacities)
 
     def prune(self, voxel_position):
+        if self.is_outside_grid(*voxel_position):
+            return False
         voxel = self.voxel_by_position(*voxel_position)
         if (voxel[0] > Voxel.VOXEL_PRUNING_OPACITY_THRESHOLD):
             return False
@@ -525,42 +808,50 @@ class VoxelGrid:
         log.info(f"Scanning neighbours...{surrounding_opacities}")
         if (surrounding_opacities.less_equal(
                 Voxel.VOXEL_PRUNING_NEIGHBOUR_OPACITY_THRESHOLDS).all()):
-            voxel.requires_grad = False
-            voxel.mul_(0)
-            Voxel.prune(voxel)
+            self.set_pruned(voxel_position)
             return True
+        return False
 
     def channel_opacity(self, distance_density_color_tensors, viewing_angle):
-        number_of_samples = len(distance_density_color_tensors)
-        density_distance_products = distance_density_color_tensors[:, 0] * distance_density_color_tensors[:, 1]
-        summing_matrix = torch.tensor(list(
-            functools.reduce(lambda acc, n: acc + [[1.] * n + [0.] * (number_of_samples - n)],
-                             range(1, number_of_samples + 1),
-                             []))).t()
-        # print(f"Sigma-D={density_distance_products.type()}, summing matrix = {summing_matrix.t().type()}")
-        transmittances = torch.matmul(density_distance_products.double(), summing_matrix.double())
-        transmittances = torch.exp(-transmittances)
-
-        red_channel, green_channel, blue_channel = [], [], []
-        for index, distance_density_color_tensor in enumerate(distance_density_color_tensors):
-            red_harmonic, green_harmonic, blue_harmonic = rgb_harmonics(
-                distance_density_color_tensor[2:])
-            r = red_harmonic(viewing_angle[0], viewing_angle[1])
-            g = green_harmonic(viewing_angle[0], viewing_angle[1])
-            b = blue_harmonic(viewing_angle[0], viewing_angle[1])
-            red_channel.append(r)
-            green_channel.append(g)
-            blue_channel.append(b)
-
-        red_channel, green_channel, blue_channel = torch.stack(red_channel), torch.stack(green_channel), torch.stack(
-            blue_channel)
+        ray_sample_distances = distance_density_color_tensors[:, 0]
+        return self.channel_opacities(distance_density_color_tensors[:, 1:].unsqueeze(0),
+                                      ray_sample_distances.unsqueeze(0),
+                                      torch.ones_like(ray_sample_distances, dtype=torch.bool).unsqueeze(0),
+                                      SPHERICAL_HARMONICS.basis_from_angles(viewing_angle))[0]
+
+    # Composites a padded batch of rays in one go. sample_voxels is (num_rays, num_samples, VOXEL_DIMENSION),
+    # ray_sample_distances and sample_mask are (num_rays, num_samples); masked samples contribute nothing.
+    # harmonic_basis is a spherical harmonic basis which broadcasts against (num_rays, num_samples, K).
+    # The transmittance at a sample is exp(-sum of density * distance up to and including that sample),
+    # which is a cumulative sum along the ray instead of a product with a lower-triangular summing matrix.
+    def channel_opacities(self, sample_voxels, ray_sample_distances, sample_mask, harmonic_basis):
+        densities = sample_voxels[..., 0]
+        harmonic_coefficients = sample_voxels[..., 1:].reshape(*densities.shape, 3, VoxelGrid.PER_CHANNEL_DIMENSION)
+        colours = SphericalHarmonics.colours(harmonic_coefficients, harmonic_basis)
+
+        density_distance_products = densities * ray_sample_distances * sample_mask
+        transmittances = torch.exp(-torch.cumsum(density_distance_products.double(), dim=1))
         base_transmittance_factors = transmittances * (1 - torch.exp(- density_distance_products))
-        red = (base_transmittance_factors * red_channel).sum()
-        green = (base_transmittance_factors * green_channel).sum()
-        blue = (base_transmittance_factors * blue_channel).sum()
-
-        color_densities = torch.stack([red, green, blue])
-        return color_densities
+        color_densities = (base_transmittance_factors.unsqueeze(-1) * colours).sum(1)
+        return color_densities.float()
+
+    # Trilinear interpolation weights of the 8 interpolating neighbours of each sample position
+    def interpolating_weights(self, ray_sample_positions):
+        voxel_positions = self.to_voxel_coordinates(ray_sample_positions)
+        fractions = (ray_sample_positions / self.scale - voxel_positions).unsqueeze(-2)
+        return torch.where(VoxelGrid.INTERPOLATING_NEIGHBOUR_OFFSETS == 1, fractions, 1 - fractions).prod(-1)
+
+    # Transmittance in front of each sample, i.e. before it absorbs any light, from the densities alone.
+    # This is exp(-sum of density * distance over all earlier samples).
+    def transmittances_from_rays(self, voxel_access):
+        densities = self.interpolate_samples(voxel_access, channels=slice(0, 1))[..., 0]
+        density_distance_products = densities * voxel_access.ray_sample_distances * voxel_access.sample_mask
+        return torch.exp(-(torch.cumsum(density_distance_products.double(), dim=1) - density_distance_products))
+
+    def density_from_rays(self, voxel_access, harmonic_basis):
+        sample_voxels = self.interpolate_samples(voxel_access)
+        return self.channel_opacities(sample_voxels, voxel_access.ray_sample_distances, voxel_access.sample_mask,
+                                      harmonic_basis)
 
     def to_voxel_cube_spec(self, world_cube_spec):
         x1, y1, z1, dx, dy, dz = world_cube_spec
@@ -590,7 +881,7 @@ class VoxelGrid:
 
     def build_solid_cube(self, cube_spec):
         for i, j, k, _ in self.voxels_in_world(cube_spec):
-            self.voxel_grid[i, j, k] = Voxel.occupied_voxel(0.2)()
+            self.set((i, j, k), Voxel.occupied_voxel(0.2)())
 
     def build_monochrome_hollow_cube(self, cube_spec):
         self.build_hollow_cube_with_randomly_coloured_sides(Voxel.default_voxel(), cube_spec)
@@ -600,27 +891,22 @@ class VoxelGrid:
         face1, face2, face3, face4, face5, face6 = cube_faces(cube_spec)
 
         for i, j, k, _ in self.voxels_in_world(face1):
-            self.voxel_grid[i, j, k] = voxel_1
+            self.set((i, j, k), voxel_1)
         for i, j, k, _ in self.voxels_in_world(face2):
-            self.voxel_grid[i, j, k] = voxel_2
+            self.set((i, j, k), voxel_2)
         for i, j, k, _ in self.voxels_in_world(face3):
-            self.voxel_grid[i, j, k] = voxel_3
+            self.set((i, j, k), voxel_3)
         for i, j, k, _ in self.voxels_in_world(face4):
-            self.voxel_grid[i, j, k] = voxel_4
+            self.set((i, j, k), voxel_4)
         for i, j, k, _ in self.voxels_in_world(face5):
-            self.voxel_grid[i, j, k] = voxel_5
+            self.set((i, j, k), voxel_5)
         for i, j, k, _ in self.voxels_in_world(face6):
-            self.voxel_grid[i, j, k] = voxel_6
+            self.set((i, j, k), voxel_6)
 
     def density(self, ray_samples_with_positions_distances, viewing_angle):
-        global MASTER_VOXELS_STRUCTURE
-        collected_intensities = []
-        for ray_sample in ray_samples_with_positions_distances:
-            ray_sample_world_position = ray_sample[:3]
-            collected_intensities.append(
-                self.intensities(ray_sample_world_position, self.interpolating_neighbours(ray_sample_world_position)))
+        collected_intensities = self.interpolate(ray_samples_with_positions_distances[:, :3])
         return self.channel_opacity(
-            torch.cat([ray_samples_with_positions_distances[:, 3:], torch.stack(collected_intensities)], 1),
+            torch.cat([ray_samples_with_positions_distances[:, 3:], collected_intensities], 1),
             viewing_angle)
 
     def density_split(self, ray_sample_distances, ray, viewing_angle):
@@ -634,18 +920,33 @@ class VoxelGrid:
         return self.channel_opacity(torch.cat([ray_sample_distances, torch.stack(collected_intensities)], 1),
                                     viewing_angle)
 
-    def interpolating_neighbours(self, ray_sample_world_position):
-        x_0, x_1, y_0, y_1, z_0, z_1, _1, _2, _3 = self.interpolating_neighbour_endpoints(ray_sample_world_position)
-        c_000 = self.voxel_by_position(x_0, y_0, z_0)
-        c_001 = self.voxel_by_position(x_0, y_0, z_1)
-        c_010 = self.voxel_by_position(x_0, y_1, z_0)
-        c_011 = self.voxel_by_position(x_0, y_1, z_1)
-        c_100 = self.voxel_by_position(x_1, y_0, z_0)
-        c_101 = self.voxel_by_position(x_1, y_0, z_1)
-        c_110 = self.voxel_by_position(x_1, y_1, z_0)
-        c_111 = self.voxel_by_position(x_1, y_1, z_1)
-
-        return (c_000, c_001, c_010, c_011, c_100, c_101, c_110, c_111)
+    # Trilinearly interpolates the grid at a (..., 3) tensor of world positions, giving (..., VOXEL_DIMENSION),
+    # or only the given channels. The result is differentiable with respect to the grid.
+    def interpolate(self, world_positions, channels=None):
+        return self.interpolate_corners(self.interpolating_corners(world_positions),
+                                        self.interpolating_weights(world_positions), channels)
+
+    # Interpolates the grid at the samples of a VoxelAccess, reusing its corner indices, and its trilinear
+    # weights if it carries them, so that only the voxel values themselves are gathered
+    def interpolate_samples(self, voxel_access, channels=None):
+        weights = voxel_access.interpolating_weights
+        if (weights is None):
+            weights = self.interpolating_weights(voxel_access.ray_sample_positions)
+        return self.interpolate_corners(voxel_access.voxel_positions, weights, channels)
+
+    def interpolate_corners(self, corner_positions, weights, channels=None):
+        return (weights.unsqueeze(-1) * self.corner_voxels_at(corner_positions, channels)).sum(-2)
+
+    # The integer positions of the 8 interpolating corners of each world position, as (..., 8, 3)
+    def interpolating_corners(self, world_positions):
+        voxel_positions = self.to_voxel_coordinates(world_positions).long()
+        return voxel_positions.unsqueeze(-2) + VoxelGrid.INTERPOLATING_NEIGHBOUR_OFFSETS
+
+    # The voxels at a (..., 8, 3) tensor of interpolating corner positions, as (..., 8, num_channels).
+    # All 8 corners of all positions are fetched with a single gather through voxels_at(), which clamps the
+    # indices into the grid and masks out corners outside it, so that the grid itself is never copied.
+    def corner_voxels_at(self, corner_positions, channels=None):
+        return self.voxels_at(corner_positions, channels)
 
     def interpolating_neighbour_endpoints(self, ray_sample_world_coords):
         # print(f"Scale is {self.scale}")
@@ -660,7 +961,6 @@ class VoxelGrid:
         return x_0, x_1, y_0, y_1, z_0, z_1, x_d, y_d, z_d
 
     def intensities(self, ray_sample_world_position, interpolating_neighbours):
-        global MASTER_VOXELS_STRUCTURE
         _, _, _, _, _, _, x_d, y_d, z_d = self.interpolating_neighbour_endpoints(ray_sample_world_position)
         c_000, c_001, c_010, c_011, c_100, c_101, c_110, c_111 = interpolating_neighbours
 
@@ -671,7 +971,8 @@ class VoxelGrid:
         c_0 = c_00 * (1 - y_d) + c_10 * y_d
         c_1 = c_01 * (1 - y_d) + c_11 * y_d
         c = c_0 * (1 - z_d) + c_1 * z_d
-        MASTER_VOXELS_STRUCTURE += [c_000, c_001, c_010, c_011, c_100, c_101, c_110, c_111]
+        if DebugCapture.ACTIVE is not None:
+            DebugCapture.record("voxels", torch.stack([c_000, c_001, c_010, c_011, c_100, c_101, c_110, c_111]))
         if (c[0].abs() > 900):
             log.warning(f"WARNING: Bad neighbouring tensor at {(ray_sample_world_position)}")
             log.warning(f"WARNING: {(x_d, y_d, z_d)}")
@@ -704,19 +1005,184 @@ class VoxelGrid:
                 voxel_y < 0 or voxel_y >= self.voxel_grid_y or
                 voxel_z < 0 or voxel_z >= self.voxel_grid_z):
             return torch.zeros(VoxelGrid.VOXEL_DIMENSION)
-        return self.voxel_grid[voxel_x, voxel_y, voxel_z]
+        voxel = self.voxel_grid[voxel_x, voxel_y, voxel_z]
+        if self.pruned[voxel_x, voxel_y, voxel_z]:
+            # Pruned voxels are constant, so they are handed out detached from the grid
+            voxel = voxel.detach()
+            voxel.pruned = True
+        return voxel
+
+
+# Sparse backend for VoxelGrid. Only unpruned voxels are stored, as the rows of a compact
+# (num_rows, VOXEL_DIMENSION) feature table, and an int32 (X, Y, Z) grid of links maps each voxel
+# to its row. Row 0 is an empty voxel which every pruned voxel links to, so lookups in empty space
+# need no special-casing. Empty space costs 4 bytes per voxel instead of 4 * VOXEL_DIMENSION.
+class SparseVoxelGrid(VoxelGrid):
+    EMPTY_ROW = 0
+
+    def __init__(self, links, features, scale=VoxelGrid.DEFAULT_SCALE, pruned=None):
+        self.scale = scale
+        self.grid_x, self.grid_y, self.grid_z = torch.tensor(links.shape) * self.scale
+        self.voxel_grid_x, self.voxel_grid_y, self.voxel_grid_z = links.shape
+        self.links = links
+        self.features = features
+        self.pruned = pruned if pruned is not None else links == SparseVoxelGrid.EMPTY_ROW
+        self.activated = None
+        self.occupancy = None
+        self.occupancy_key = None
+
+    # Only the unpruned voxels of the dense grid are copied into the feature table
+    @staticmethod
+    def from_dense(world):
+        unpruned = ~world.pruned
+        return SparseVoxelGrid.from_occupied(unpruned, world.voxel_grid.detach()[unpruned], world.scale,
+                                             world.pruned.clone())
+
+    # Builds a grid whose voxels are the given rows of a feature table, keeping only the rows which are
+    # linked to, in a freshly packed table
+    @staticmethod
+    def from_rows(row_grid, features, scale=VoxelGrid.DEFAULT_SCALE, pruned=None):
+        occupied = row_grid != SparseVoxelGrid.EMPTY_ROW
+        return SparseVoxelGrid.from_occupied(occupied, features.detach()[row_grid[occupied].long()], scale, pruned)
+
+    # Builds a grid from a boolean (X, Y, Z) mask of occupied voxels and the features of those voxels,
+    # in the order of occupied.nonzero(), linking each of them to a row of its own
+    @staticmethod
+    def from_occupied(occupied, occupied_features, scale=VoxelGrid.DEFAULT_SCALE, pruned=None):
+        links = torch.zeros(occupied.shape, dtype=torch.int32)
+        links[occupied] = torch.arange(1, int(occupied.sum()) + 1, dtype=torch.int32)
+        features = torch.cat([torch.zeros([1, VoxelGrid.VOXEL_DIMENSION]), occupied_features])
+        return SparseVoxelGrid(links, features, scale, pruned if pruned is not None else ~occupied)
+
+    @staticmethod
+    def copy_from(world, scale=VoxelGrid.DEFAULT_SCALE):
+        return SparseVoxelGrid(world.links.clone(), world.features.detach().clone(), scale=world.scale,
+                               pruned=world.pruned.clone())
+
+    def to_dense(self):
+        return VoxelGrid(self.features.detach()[self.links.long()], scale=self.scale, pruned=self.pruned.clone())
+
+    # Drops the rows of voxels which have been pruned since the table was last packed
+    def compacted(self):
+        return SparseVoxelGrid.from_rows(self.links, self.features, self.scale, self.pruned.clone())
+
+    # Upsamples like VoxelGrid.scale_up(), without building the dense grid. Every child voxel gets a row
+    # of its own, so that the children can be trained independently. For "trilinear", only the unpruned
+    # children are computed: each gathers the 8 parent voxels around its position j / 2 through voxels_at(),
+    # weighted 1 or 0 along axes where j is even, and 1/2 each along axes where it is odd.
+    def scale_up(self, mode="nearest"):
+        new_scale = self.scale / 2
+        log.info(f"New scaled up dimensions={self.voxel_dimensions() * 2}")
+        if mode == "nearest":
+            scaled_up_links = self.links
+            scaled_up_pruned = self.pruned
+            for dimension in range(3):
+                scaled_up_links = scaled_up_links.repeat_interleave(2, dim=dimension)
+                scaled_up_pruned = scaled_up_pruned.repeat_interleave(2, dim=dimension)
+            return SparseVoxelGrid.from_rows(scaled_up_links, self.features, new_scale, scaled_up_pruned.contiguous())
+        elif mode != "trilinear":
+            raise ValueError(f"Upsampling mode {mode} is not supported")
+        scaled_up_pruned = VoxelGrid.upsample_trilinear((~self.pruned).unsqueeze(-1).float())[..., 0] == 0
+        child_positions = (~scaled_up_pruned).nonzero()
+        parent_corners = (child_positions // 2).unsqueeze(-2) + VoxelGrid.INTERPOLATING_NEIGHBOUR_OFFSETS
+        halfway = (child_positions % 2 == 1).unsqueeze(-2)
+        weights = torch.where(halfway, 0.5, 1. - VoxelGrid.INTERPOLATING_NEIGHBOUR_OFFSETS).prod(-1)
+        child_features = (weights.unsqueeze(-1) * self.voxels_at(parent_corners).detach()).sum(-2)
+        return SparseVoxelGrid.from_occupied(~scaled_up_pruned, child_features, new_scale,
+                                             scaled_up_pruned.contiguous())
+
+    def set(self, voxel_position, voxel):
+        voxel_x, voxel_y, voxel_z = voxel_position
+        if self.is_outside_grid(voxel_x, voxel_y, voxel_z):
+            log.warning(f"[WARNING]: set() attempted to set a value at {(voxel_position)} outside grid")
+            return
+        if Voxel.is_pruned(voxel):
+            self.set_pruned(voxel_position)
+            return
+        row = int(self.links[voxel_x, voxel_y, voxel_z])
+        if row == SparseVoxelGrid.EMPTY_ROW:
+            self.links[voxel_x, voxel_y, voxel_z] = len(self.features)
+            self.features = torch.cat([self.features, voxel.detach().float().reshape(1, -1)])
+        else:
+            with torch.no_grad():
+                self.features[row] = voxel
+        self.pruned[voxel_x, voxel_y, voxel_z] = False
+
+    # Pruned voxels are unlinked from their rows; compacted() reclaims the rows
+    def set_pruned(self, voxel_position):
+        voxel_x, voxel_y, voxel_z = voxel_position
+        self.links[voxel_x, voxel_y, voxel_z] = SparseVoxelGrid.EMPTY_ROW
+        self.pruned[voxel_x, voxel_y, voxel_z] = True
+
+    def prune_where(self, pruning_mask):
+        self.links[pruning_mask] = SparseVoxelGrid.EMPTY_ROW
+        self.pruned |= pruning_mask
+
+    def densities(self):
+        return self.features[self.links.long(), 0].detach()
+
+    def stored_densities(self):
+        return self.features[self.links[~self.pruned].long(), 0]
+
+    def dense_voxels(self):
+        raise ValueError("A sparse world has no dense voxel grid; use a sampled or touched mode instead")
+
+    def storage(self):
+        return self.features
+
+    def buffers(self):
+        return {"pruned": self.pruned, "links": self.links}
+
+    def with_storage(self, storage, buffers):
+        return SparseVoxelGrid(buffers["links"], storage, scale=self.scale, pruned=buffers["pruned"])
+
+    def storage_gradient_mask(self):
+        trainable_rows = torch.zeros(len(self.features), dtype=torch.bool)
+        trainable_rows[self.links[self.trainable()].long()] = True
+        trainable_rows[SparseVoxelGrid.EMPTY_ROW] = False
+        return trainable_rows.unsqueeze(-1)
+
+    # Rows of the voxels at a (..., 3) tensor of voxel positions; positions outside the grid give the empty row
+    def rows_at(self, voxel_positions):
+        inside = self.inside_grid_mask(voxel_positions)
+        clamped = torch.minimum(voxel_positions.clamp(min=0), self.voxel_dimensions().long() - 1)
+        rows = self.links[clamped[..., 0], clamped[..., 1], clamped[..., 2]].long()
+        return rows * inside
+
+    def voxels_at(self, voxel_positions, channels=None):
+        features = self.features if channels is None else self.features[:, channels]
+        return features[self.rows_at(voxel_positions)]
+
+    def voxel_by_position(self, voxel_x, voxel_y, voxel_z):
+        if (voxel_x < 0 or voxel_x >= self.voxel_grid_x or
+                voxel_y < 0 or voxel_y >= self.voxel_grid_y or
+                voxel_z < 0 or voxel_z >= self.voxel_grid_z):
+            return torch.zeros(VoxelGrid.VOXEL_DIMENSION)
+        voxel = self.features[int(self.links[voxel_x, voxel_y, voxel_z])]
+        if self.pruned[voxel_x, voxel_y, voxel_z]:
+            voxel = voxel.detach()
+            voxel.pruned = True
+        return voxel
+
+
+def clamp_to_unit_interval(t):
+    return torch.clamp(t, min=0, max=1)
 
 
+# Clamping functions are plain functions or modules, so that they can be pickled into render workers
 class ClampingFunctions:
     SIGMOID = nn.Sigmoid()
-    CLAMP = lambda t: torch.clamp(t, min=0, max=1)
+    CLAMP = clamp_to_unit_interval
     DEFAULT = CLAMP
 
 
 class Renderer:
-    def __init__(self, world, camera, view_spec, ray_spec):
+    def __init__(self, world, camera, view_spec, ray_spec, redistribute_samples=False, transmittance_threshold=None):
         self.world = world
         self.camera = camera
+        self.redistribute_samples = redistribute_samples
+        self.transmittance_threshold = transmittance_threshold
+        self.num_terminated_samples = 0
         self.ray_length = ray_spec[0]
         self.num_ray_samples = ray_spec[1]
         self.x_1, self.x_2 = view_spec[0], view_spec[1]
@@ -726,20 +1192,14 @@ class Renderer:
 
     def render_from_ray(self, ray, viewing_angle, clamping_function):
         # print(f"Wall clock in render_from_ray() is {timer()}")
-        ray_sample_positions = ray.ray_sample_positions
-        unique_ray_samples = ray_sample_positions
         view_x, view_y = ray.view_point
 
-        if (len(unique_ray_samples) <= 1):
+        if (ray.num_samples == 0):
             return torch.tensor([view_x, view_y, 0., 0., 0.])
 
-        t1 = unique_ray_samples[:-1]
-        t2 = unique_ray_samples[1:]
-        consecutive_sample_distances = (t1 - t2).pow(2).sum(1).sqrt()
-
         # Make 1D tensor into 2D tensor
         # List of tensors, each entry is distance from i-th sample to the next sample
-        ray_sample_distances = torch.reshape(consecutive_sample_distances, (-1, 1))
+        ray_sample_distances = torch.reshape(ray.ray_sample_distances, (-1, 1))
         color_densities = self.world.density_split(ray_sample_distances, ray, viewing_angle)
         color_tensor = clamping_function(color_densities * ARBITRARY_SCALE)
 
@@ -753,46 +1213,49 @@ class Renderer:
     def render_from_rays(self, voxel_access, clamping_function=ClampingFunctions.DEFAULT):
         X, Y = 0, 1
         RED_CHANNEL, GREEN_CHANNEL, BLUE_CHANNEL = 2, 3, 4
-        camera = self.camera
-        # composite_colour_tensors = self.render_parallel(voxel_access, camera)
-        composite_colour_tensors = self.render_serial(voxel_access, camera, clamping_function)
+        if (self.transmittance_threshold is not None):
+            voxel_access = self.terminate_rays(voxel_access)
+        if DebugCapture.ACTIVE is not None:
+            DebugCapture.record("ray_sample_positions", voxel_access.ray_sample_positions[voxel_access.sample_mask])
+        color_densities = self.world.density_from_rays(voxel_access, self.harmonic_basis(voxel_access))
+        color_tensors = clamping_function(color_densities * ARBITRARY_SCALE)
+        composite_colour_tensors = torch.cat([voxel_access.view_points, color_tensors], 1)
         red_channel = composite_colour_tensors[:, [X, Y, RED_CHANNEL]]
         green_channel = composite_colour_tensors[:, [X, Y, GREEN_CHANNEL]]
         blue_channel = composite_colour_tensors[:, [X, Y, BLUE_CHANNEL]]
         log.info("Done volumetric calculations from rays!!")
         return (red_channel, green_channel, blue_channel)
 
+    # Early ray termination: a density-only pass without gradients finds where the transmittance in front
+    # of each sample falls below transmittance_threshold, and those samples are dropped before compositing.
+    # The samples which are kept composite exactly as before, so their gradients are unaffected; the
+    # dropped samples could have contributed at most transmittance_threshold of the light on their ray.
+    def terminate_rays(self, voxel_access):
+        with torch.no_grad():
+            transmittances = self.world.transmittances_from_rays(voxel_access)
+        sample_mask = voxel_access.sample_mask & (transmittances >= self.transmittance_threshold)
+        self.num_terminated_samples = int(voxel_access.sample_mask.sum() - sample_mask.sum())
+        log.info(f"Early ray termination skipped {self.num_terminated_samples} samples")
+        return voxel_access.compacted(sample_mask)
+
+    # The spherical harmonic basis of the viewing direction of each of the rays
+    def harmonic_basis(self, voxel_access):
+        return SPHERICAL_HARMONICS.basis_for_camera(self.camera)
+
+    # Keyword arguments which recreate this renderer's sampling and compositing behaviour, e.g. in render workers
+    def options(self):
+        return dict(redistribute_samples=self.redistribute_samples,
+                    transmittance_threshold=self.transmittance_threshold)
+
     def render_serial(self, voxel_access, camera, clamping_function):
         viewing_angle = camera.viewing_angle()
-        num_view_points = len(voxel_access.view_points)
+        num_view_points = voxel_access.num_rays()
         composite_colour_tensors = torch.stack(list(
-            map(lambda index: self.render_from_ray(voxel_access.for_ray(index), viewing_angle, clamping_function),
+            map(lambda index: self.render_from_ray(voxel_access.for_ray(index, self.world), viewing_angle,
+                                                   clamping_function),
                 range(num_view_points))))
         return composite_colour_tensors
 
-    def render_from_angle(self, ray):
-        return self.render_from_ray(ray, self.camera.viewing_angle(), clamping_function=ClampingFunctions.DEFAULT)
-
-    def render_parallel(self, voxel_access, camera):
-        viewing_angle = camera.viewing_angle()
-        num_view_points = len(voxel_access.view_points)
-        workers = os.cpu_count()
-        p = tmp.Pool(workers)
-        start_copy_rays = timer()
-        rays = list(map(lambda i: voxel_access.for_ray(i), range(num_view_points)))
-        end_copy_rays = timer()
-        log.info(f"Copying rays took {end_copy_rays - start_copy_rays}")
-        log.info(f"Wall clock is {timer()}")
-        start_render_rays = timer()
-        # responses = p.map(lambda ray: self.render_from_ray(ray, viewing_angle), rays)
-        responses = p.map(self.render_from_angle, rays)
-        p.close()
-        p.join()
-        end_render_rays = timer()
-        log.info(f"Actual rendering took {end_render_rays - start_render_rays}")
-        composite_colour_tensors = torch.stack(list(responses))
-        return composite_colour_tensors
-
     @staticmethod
     def initialise_plt(plt):
         plt.rcParams['axes.xmargin'] = 0
@@ -806,157 +1269,337 @@ class Renderer:
         plt.axis("off")
         return figure
 
+    # Builds all rays in one batch: every sample point of every ray is computed as a
+    # (num_rays, num_samples, 3) tensor, samples outside the grid are masked out, and
+    # the 8 interpolating corner indices of each sample come out as an integer tensor.
+    # Only the [t_near, t_far] segment of each ray inside the world is sampled. By default these
+    # are the same samples as stepping along the full ray length; if redistribute_samples is set,
+    # the whole sample budget is spread over the segment inside the world instead.
     def build_rays(self, ray_intersection_weights):
+        return self.skip_empty_space(self.build_ray_geometry(ray_intersection_weights))
+
+    # The rays as far as they depend on the camera, the view and ray specs and the shape of the world, but
+    # not on the voxel values or the pruning: samples in empty space are still present.
+    def build_ray_geometry(self, ray_intersection_weights):
         camera = self.camera
+        if not torch.is_tensor(ray_intersection_weights):
+            ray_intersection_weights = torch.stack(list(ray_intersection_weights))
+        ray_intersection_weights = ray_intersection_weights.float()
         camera_basis_x = camera.basis[0][:3]
         camera_basis_y = camera.basis[1][:3]
         camera_basis_z = camera.basis[2][:3]
         camera_center_inhomogenous = camera.center[:3]
-        all_voxel_positions = []
-        view_points = []
-        voxel_pointers = []
-        all_voxels = []
-        ray_sample_positions = []
         view_screen_origin = camera_basis_z * camera.focal_length + camera_center_inhomogenous
-        counter = 0
-        for ray_intersection_weight in ray_intersection_weights:
-            ray_screen_intersection = camera_basis_x * ray_intersection_weight[0] + \
-                                      camera_basis_y * ray_intersection_weight[1] + view_screen_origin
-            unit_ray = unit_vector(ray_screen_intersection - camera_center_inhomogenous)
-            view_x, view_y = ray_intersection_weight[0], ray_intersection_weight[1]
-            num_intersecting_voxels = 0
-
-            all_voxels_per_ray = []
-            all_voxel_positions_per_ray = []
-            ray_sample_positions_per_ray = []
-            for k in np.linspace(0, self.ray_length, int(self.num_ray_samples)):
-                ray_endpoint = camera_center_inhomogenous + unit_ray * k
-                ray_x, ray_y, ray_z = ray_endpoint
-                if (self.world.is_outside(ray_x, ray_y, ray_z)):
-                    continue
-                # We are in the box
-                interpolating_voxels, interpolating_voxel_positions = self.world.neighbours(ray_x, ray_y, ray_z)
-                num_intersecting_voxels += 1
-                all_voxels_per_ray += interpolating_voxels
-                all_voxel_positions_per_ray += interpolating_voxel_positions
-                ray_sample_positions_per_ray.append(torch.tensor([ray_x, ray_y, ray_z]))
-            if (num_intersecting_voxels <= 1):
-                continue
-            all_voxels += all_voxels_per_ray
-            all_voxel_positions += all_voxel_positions_per_ray
-            ray_sample_positions += ray_sample_positions_per_ray
-
-            view_points.append((view_x, view_y))
-            voxel_pointers.append(
-                (counter, counter + Voxel.NUM_INTERPOLATING_VOXEL_NEIGHBOURS * num_intersecting_voxels,
-                 num_intersecting_voxels))
-            counter += Voxel.NUM_INTERPOLATING_VOXEL_NEIGHBOURS * num_intersecting_voxels
-
-            if (view_x < self.x_1 or view_x > self.x_2
-                    or view_y < self.y_1 or view_y > self.y_2):
-                log.warning(f"[WARNING]: bad generation: {view_x}, {view_y}")
+        ray_screen_intersections = ray_intersection_weights[:, :1] * camera_basis_x + \
+                                   ray_intersection_weights[:, 1:] * camera_basis_y + view_screen_origin
+        rays = ray_screen_intersections - camera_center_inhomogenous
+        unit_rays = rays / rays.norm(dim=1, keepdim=True)
+        return self.ray_geometry(camera_center_inhomogenous, unit_rays, ray_intersection_weights)
+
+    # Samples rays with the given origins and unit directions through the world. ray_origins is either a
+    # single origin or one per ray. The returned VoxelAccess only holds the rays which intersect the world;
+    # its ray_indices give their positions among the rays passed in.
+    def ray_geometry(self, ray_origins, unit_rays, view_points):
+        t_near, t_far = self.world.ray_intersections(ray_origins, unit_rays)
+        t_near, t_far = t_near.clamp(min=0), t_far.clamp(max=float(self.ray_length))
+        ray_steps, valid_steps = self.ray_steps(t_near, t_far)
+        ray_sample_positions = ray_origins.reshape(-1, 1, 3) + unit_rays.unsqueeze(1) * ray_steps.unsqueeze(2)
+        inside = self.world.inside_world_mask(ray_sample_positions) & valid_steps
+
+        # Only samples which have a next sample inside the grid are composited
+        next_inside = torch.cat([inside[:, 1:], torch.zeros_like(inside[:, :1])], 1)
+        sample_mask = inside & next_inside
+        consecutive_sample_distances = (ray_sample_positions[:, 1:] - ray_sample_positions[:, :-1]).norm(dim=2)
+        ray_sample_distances = torch.cat([consecutive_sample_distances,
+                                          torch.zeros_like(consecutive_sample_distances[:, :1])], 1)
+
+        intersecting_rays = sample_mask.any(1)
+        sample_mask, ray_sample_positions, ray_sample_distances = compact_samples(
+            sample_mask[intersecting_rays], ray_sample_positions[intersecting_rays],
+            ray_sample_distances[intersecting_rays])
+        view_points = view_points[intersecting_rays]
+        ray_indices = intersecting_rays.nonzero()[:, 0]
+        voxel_positions = self.world.interpolating_corners(ray_sample_positions)
+        interpolating_weights = self.world.interpolating_weights(ray_sample_positions)
+
+        view_x, view_y = view_points[:, 0], view_points[:, 1]
+        if ((view_x < self.x_1) | (view_x > self.x_2) | (view_y < self.y_1) | (view_y > self.y_2)).any():
+            log.warning("[WARNING]: bad generation of view points")
         log.info("Done building candidate rays!!")
 
-        return VoxelAccess(view_points, torch.stack(ray_sample_positions), voxel_pointers, all_voxels,
-                           all_voxel_positions)
-
-    def render(self, plt, clamping_function=ClampingFunctions.DEFAULT, text=None):
-        RED_CHANNEL, GREEN_CHANNEL, BLUE_CHANNEL = 0, 1, 2
-        global VOXELS_NOT_USED
-        global MASTER_RAY_SAMPLE_POSITIONS_STRUCTURE
-        red_image = []
-        green_image = []
-        blue_image = []
-        camera = self.camera
-        camera_basis_x = camera.basis[0][:3]
-        camera_basis_y = camera.basis[1][:3]
-        camera_basis_z = camera.basis[2][:3]
-        viewing_angle = camera.viewing_angle()
-        camera_center_inhomogenous = camera.center[:3]
-
-        Renderer.initialise_plt(plt)
-        log.info(f"Camera basis={camera.basis}")
-        view_screen_origin = camera_basis_z * camera.focal_length + camera_center_inhomogenous
-        log.info(f"View screen origin={view_screen_origin}")
-        for i in np.linspace(self.x_1, self.x_2, int(self.num_view_samples_x)):
-            red_column = []
-            green_column = []
-            blue_column = []
-            for j in np.linspace(self.y_1, self.y_2, int(self.num_view_samples_y)):
-                ray_screen_intersection = camera_basis_x * i + camera_basis_y * j + view_screen_origin
-                unit_ray = unit_vector(ray_screen_intersection - camera_center_inhomogenous)
-                # print(f"Camera basis is {camera.basis}, Camera center is {camera_center_inhomogenous}, intersection is {ray_screen_intersection}, Unit ray is [{unit_ray}]")
-                ray_samples = []
-                # To remove artifacts, set ray step samples to be higher, like 200
-                for k in np.linspace(0, self.ray_length, int(self.num_ray_samples)):
-                    ray_endpoint = camera_center_inhomogenous + unit_ray * k
-                    ray_x, ray_y, ray_z = ray_endpoint
-                    if (self.world.is_outside(ray_x, ray_y, ray_z)):
-                        # print(
-                        # f"Skipping [{ray_x},{ray_y},{ray_z}], k={k}, unit ray={unit_ray}, camera is {camera_center_inhomogenous}")
-                        continue
-                    # We are in the box
-                    ray_samples.append([ray_x, ray_y, ray_z])
-                    # print(
-                    #     f"Sample at ({[ray_x, ray_y, ray_z]}), voxel value here is {self.world.at(ray_x, ray_y, ray_z)}")
-
-                # unique_ray_samples = torch.unique(torch.tensor(ray_samples), dim=0)
-                unique_ray_samples = torch.tensor(ray_samples)
-                if (len(unique_ray_samples) <= 1):
-                    red_column.append(torch.tensor(0))
-                    green_column.append(torch.tensor(0))
-                    blue_column.append(torch.tensor(0))
-                    plt.plot(i, j, marker="o", color=Empty.EMPTY_RGB().detach().numpy())
-                    # print("Too few")
-                    continue
-
-                MASTER_RAY_SAMPLE_POSITIONS_STRUCTURE += unique_ray_samples
-                VOXELS_NOT_USED += 8
-                t1 = unique_ray_samples[:-1]
-                t2 = unique_ray_samples[1:]
-                consecutive_sample_distances = (t1 - t2).pow(2).sum(1).sqrt()
-                # print(consecutive_sample_distances)
-
-                # Make 1D tensor into 2D tensor
-                ray_samples_with_distances = torch.cat([t1, torch.reshape(consecutive_sample_distances, (-1, 1))], 1)
-                # print(ray_samples_with_distances)
-                color_densities = self.world.density(ray_samples_with_distances, viewing_angle)
-
-                # color_tensor = torch.clamp(color_densities, min=0, max=1)
-                color_tensor = clamping_function(color_densities * ARBITRARY_SCALE)
-                # print(color_tensor)
-                plt.plot(i, j, marker="o", color=color_tensor.detach().numpy())
-                red_column.append(color_tensor[RED_CHANNEL])
-                green_column.append(color_tensor[GREEN_CHANNEL])
-                blue_column.append(color_tensor[BLUE_CHANNEL])
-            red_image.append(torch.tensor(red_column))
-            green_image.append(torch.tensor(green_column))
-            blue_image.append(torch.tensor(blue_column))
-
-        # Flip to prevent image being rendered upside down when saved to a file
-        red_image_tensor = torch.flip(torch.stack(red_image).t(), [0])
-        green_image_tensor = torch.flip(torch.stack(green_image).t(), [0])
-        blue_image_tensor = torch.flip(torch.stack(blue_image).t(), [0])
+        return VoxelAccess(view_points, ray_sample_positions, ray_sample_distances, sample_mask, voxel_positions,
+                           interpolating_weights, ray_indices)
+
+    # Samples in empty space are skipped only after the distances are taken, so that the distance
+    # carried by each remaining sample is unchanged. Rays which cross only empty space are kept,
+    # and composite to the background.
+    def skip_empty_space(self, voxel_access):
+        return voxel_access.compacted(
+            voxel_access.sample_mask & self.world.occupied_mask(voxel_access.ray_sample_positions))
+
+    def view_spec(self):
+        return [self.x_1, self.x_2, self.y_1, self.y_2, self.num_view_samples_x, self.num_view_samples_y]
+
+    def ray_spec(self):
+        return [self.ray_length, self.num_ray_samples]
+
+    # Everything the ray geometry depends on, as a hashable key
+    def geometry_key(self):
+        def values(t):
+            return tuple(float(v) for v in (t.reshape(-1) if torch.is_tensor(t) else t))
+
+        return (values(self.camera.center[:3]), values(self.camera.look_at[:3]), values([self.camera.focal_length]),
+                values(self.view_spec()), values(self.ray_spec()), self.redistribute_samples,
+                values(self.world.voxel_dimensions()), values(self.world.scale))
+
+    # Distances along each ray at which it is sampled, as a (num_rays, num_steps) tensor, with a mask
+    # of which steps lie within [t_near, t_far]
+    def ray_steps(self, t_near, t_far):
+        num_ray_samples = int(self.num_ray_samples)
+        if self.redistribute_samples:
+            t_near, t_far = t_near + RAY_BOX_EPSILON, t_far - RAY_BOX_EPSILON
+            segment_lengths = (t_far - t_near).clamp(min=0)
+            ray_steps = t_near.unsqueeze(1) + segment_lengths.unsqueeze(1) * torch.linspace(0, 1, num_ray_samples)
+            return (ray_steps, (t_far >= t_near).unsqueeze(1).expand_as(ray_steps))
+
+        # Pick out the steps of the full-length ray which can fall between t_near and t_far. The range is
+        # rounded outwards; the inside-world check on the sample positions settles the boundary steps.
+        all_ray_steps = torch.linspace(0, float(self.ray_length), num_ray_samples)
+        step_length = float(self.ray_length) / max(num_ray_samples - 1, 1)
+        first_steps = torch.floor(t_near / step_length).long().clamp(min=0)
+        last_steps = torch.ceil(t_far / step_length).long().clamp(max=num_ray_samples - 1)
+        num_steps = (last_steps - first_steps + 1).clamp(min=0)
+        max_steps = int(num_steps.max()) if len(num_steps) > 0 else 0
+        step_indices = first_steps.unsqueeze(1) + torch.arange(max_steps)
+        valid_steps = torch.arange(max_steps).unsqueeze(0) < num_steps.unsqueeze(1)
+        return (all_ray_steps[step_indices.clamp(max=num_ray_samples - 1)], valid_steps)
+
+    # Renders the full view screen without touching matplotlib: all rays are built and composited
+    # as one batch, and the colours are scattered straight into image tensors. If plt is supplied,
+    # the finished image is previewed with a single imshow(). If a RenderPool is supplied, the rays
+    # are rendered tile by tile on its worker processes instead.
+    def render(self, plt=None, clamping_function=ClampingFunctions.DEFAULT, text=None, render_pool=None):
+        view_spec = self.view_spec()
+        log.info(f"Camera basis={self.camera.basis}")
+        if (render_pool is not None):
+            r, g, b, self.num_terminated_samples = render_pool.render_rays(self.camera, view_spec, self.ray_spec(),
+                                                                           fullscreen_samples(view_spec),
+                                                                           clamping_function, self.options())
+            log.info(f"Early ray termination skipped {self.num_terminated_samples} samples")
+        else:
+            with torch.no_grad():
+                voxel_access = self.build_rays(fullscreen_samples(view_spec))
+                r, g, b = self.render_from_rays(voxel_access, clamping_function=clamping_function)
 
-        if (text is not None):
-            plt.text(0.5, 0.5, text, fontsize=14, backgroundcolor="white", alpha=0.5, color="black")
-        plt.show()
+        red_image_tensor, green_image_tensor, blue_image_tensor = fullscreen_image(r, g, b, view_spec)
+        if (plt is not None):
+            self.plot_from_image(torch.stack([red_image_tensor, green_image_tensor, blue_image_tensor]), plt, text)
         log.info("Done rendering in full!!")
         return (red_image_tensor, green_image_tensor, blue_image_tensor)
 
     def plot_from_image(self, image_data, plt, text=None):
         Renderer.initialise_plt(plt)
-        red_render_channel, green_render_channel, blue_render_channel = image_data.detach().numpy()
-        width, height = red_render_channel.shape
-        for i in range(width):
-            for j in range(height):
-                plt.plot(i, height - 1 - j, marker="o",
-                         color=[red_render_channel[j, i], green_render_channel[j, i], blue_render_channel[j, i]])
+        plt.imshow(image_data.detach().clamp(0, 1).permute(1, 2, 0).numpy(), interpolation="nearest")
         if (text is not None):
             plt.text(0.5, 0.5, text, fontsize=14, backgroundcolor="white", alpha=0.5, color="black")
         plt.show()
 
 
+# Renders a minibatch of rays drawn from many views at once, as in the Plenoxels paper. Ray i is cast by
+# cameras[camera_indices[i]], so the rays of all the views are built, composited and differentiated as a
+# single batch, each with the spherical harmonic basis of its own camera.
+class MultiViewRenderer(Renderer):
+    def __init__(self, world, cameras, camera_indices, view_spec, ray_spec, transmittance_threshold=None):
+        super().__init__(world, cameras[0], view_spec, ray_spec, transmittance_threshold=transmittance_threshold)
+        self.cameras = cameras
+        self.camera_indices = camera_indices
+
+    def build_ray_geometry(self, ray_intersection_weights):
+        ray_intersection_weights = ray_intersection_weights.float()
+        camera_centers = torch.stack([camera.center[:3] for camera in self.cameras])[self.camera_indices]
+        camera_bases = torch.stack([camera.basis[:3, :3] for camera in self.cameras])[self.camera_indices]
+        focal_lengths = torch.tensor([float(camera.focal_length) for camera in self.cameras])[self.camera_indices]
+        rays = ray_intersection_weights[:, :1] * camera_bases[:, 0] + \
+               ray_intersection_weights[:, 1:] * camera_bases[:, 1] + focal_lengths.unsqueeze(1) * camera_bases[:, 2]
+        unit_rays = rays / rays.norm(dim=1, keepdim=True)
+        return self.ray_geometry(camera_centers, unit_rays, ray_intersection_weights)
+
+    def harmonic_basis(self, voxel_access):
+        camera_bases = torch.stack([SPHERICAL_HARMONICS.basis_for_camera(camera) for camera in self.cameras])
+        return camera_bases[self.camera_indices[voxel_access.ray_indices]].unsqueeze(1)
+
+
+# Ray geometry depends only on the camera pose, the view and ray specs and the shape of the world, so for
+# the fixed training cameras it is built once and reused in every later epoch; only the voxel values are
+# gathered afresh. Each entry keeps the lower interpolating corner of every sample as int16, from which the
+# other 7 corners follow, alongside the sample positions, distances and trilinear weights. Skipping empty
+# space depends on the current pruning, so it is applied to the cached geometry on every lookup.
+class RayCache:
+    GEOMETRY_TENSORS = ["view_points", "ray_sample_positions", "ray_sample_distances", "sample_mask",
+                        "lower_corners", "interpolating_weights"]
+
+    def __init__(self):
+        self.entries = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        return self.entries.get(key)
+
+    def store(self, key, geometry):
+        self.entries[key] = geometry
+
+    def fullscreen_rays(self, renderer):
+        key = renderer.geometry_key()
+        geometry = self.lookup(key)
+        if (geometry is not None):
+            self.num_hits += 1
+        else:
+            self.num_misses += 1
+            voxel_access = renderer.build_ray_geometry(fullscreen_samples(renderer.view_spec()))
+            self.store(key, (voxel_access.view_points, voxel_access.ray_sample_positions,
+                             voxel_access.ray_sample_distances, voxel_access.sample_mask,
+                             voxel_access.voxel_positions[:, :, 0].short(), voxel_access.interpolating_weights))
+            geometry = self.lookup(key)
+        view_points, ray_sample_positions, ray_sample_distances, sample_mask, lower_corners, weights = geometry
+        voxel_positions = lower_corners.long().unsqueeze(2) + VoxelGrid.INTERPOLATING_NEIGHBOUR_OFFSETS
+        return renderer.skip_empty_space(VoxelAccess(view_points, ray_sample_positions, ray_sample_distances,
+                                                     sample_mask, voxel_positions, weights))
+
+
+# Writes a tensor as a raw binary file, returning the dtype and shape needed to map it back
+def write_tensor_file(filename, tensor):
+    tensor.detach().contiguous().numpy().tofile(filename)
+    return {"dtype": str(tensor.dtype).removeprefix("torch."), "shape": list(tensor.shape)}
+
+
+# Memory-maps a raw binary tensor file written by write_tensor_file(), without reading it up front
+def map_tensor_file(filename, tensor_spec):
+    dtype = getattr(torch, tensor_spec["dtype"])
+    num_elements = math.prod(tensor_spec["shape"])
+    if (num_elements == 0):
+        return torch.empty(tensor_spec["shape"], dtype=dtype)
+    return torch.from_file(filename, shared=False, size=num_elements, dtype=dtype).reshape(tensor_spec["shape"])
+
+
+# A RayCache which persists its entries under folder, one directory per geometry key, so that restarting
+# training skips building rays altogether. Every tensor is written as a raw binary file and memory-mapped
+# with torch.from_file() when it is read back, so it is paged in from disk as the training step touches it
+# rather than loaded up front. An entry is only used if its manifest carries the current FORMAT_VERSION and
+# exactly the requested key; the key covers the grid resolution and the ray spec, so changing either builds
+# a new entry. The manifest is written last, so an interrupted write is rebuilt as well.
+class RayStore(RayCache):
+    FORMAT_VERSION = 1
+    MANIFEST_FILENAME = "manifest.json"
+
+    def __init__(self, folder=RAY_STORE_FOLDER):
+        super().__init__()
+        self.folder = folder
+
+    def entry_folder(self, key):
+        return f"{self.folder}/{hashlib.sha1(repr(key).encode()).hexdigest()}"
+
+    def lookup(self, key):
+        geometry = super().lookup(key)
+        if (geometry is None):
+            geometry = self.read(key)
+            if (geometry is not None):
+                super().store(key, geometry)
+        return geometry
+
+    def store(self, key, geometry):
+        entry_folder = self.entry_folder(key)
+        os.makedirs(entry_folder, exist_ok=True)
+        tensor_specs = {}
+        for name, tensor in zip(RayCache.GEOMETRY_TENSORS, geometry):
+            tensor_specs[name] = write_tensor_file(f"{entry_folder}/{name}.bin", tensor)
+        with open(f"{entry_folder}/{RayStore.MANIFEST_FILENAME}", "w") as manifest_file:
+            json.dump({"version": RayStore.FORMAT_VERSION, "key": key, "tensors": tensor_specs}, manifest_file)
+        log.info(f"Stored ray geometry in {entry_folder}")
+
+    def read(self, key):
+        entry_folder = self.entry_folder(key)
+        manifest_filename = f"{entry_folder}/{RayStore.MANIFEST_FILENAME}"
+        if (not os.path.exists(manifest_filename)):
+            return None
+        with open(manifest_filename) as manifest_file:
+            manifest = json.load(manifest_file)
+        if (manifest["version"] != RayStore.FORMAT_VERSION or manifest["key"] != json.loads(json.dumps(key))):
+            log.warning(f"Ignoring stale ray geometry in {entry_folder}")
+            return None
+        return tuple(map_tensor_file(f"{entry_folder}/{name}.bin", manifest["tensors"][name])
+                     for name in RayCache.GEOMETRY_TENSORS)
+
+
+DEFAULT_RENDER_TILE_SIZE = 256
+
+# The world each render worker renders from, installed once when the worker process starts
+RENDER_WORKER_WORLD = None
+
+
+def initialise_render_worker(world):
+    global RENDER_WORKER_WORLD
+    # Parallelism comes from the pool, so each worker keeps to a single intra-op thread
+    torch.set_num_threads(1)
+    RENDER_WORKER_WORLD = world
+
+
+# Renders one tile of rays, returning its colour channels and the number of samples skipped by early
+# ray termination in it
+def render_tile(tile):
+    camera, view_spec, ray_spec, ray_intersection_weights, clamping_function, renderer_options = tile
+    renderer = Renderer(RENDER_WORKER_WORLD, camera, view_spec, ray_spec, **renderer_options)
+    with torch.no_grad():
+        voxel_access = renderer.build_rays(ray_intersection_weights)
+        if (voxel_access.num_rays() == 0):
+            return (torch.zeros([0, 3]), torch.zeros([0, 3]), torch.zeros([0, 3]), 0)
+        r, g, b = renderer.render_from_rays(voxel_access, clamping_function=clamping_function)
+        return (r, g, b, renderer.num_terminated_samples)
+
+
+# A persistent pool of render workers. The voxel storage and its buffers are moved into shared memory
+# once, so workers read the live grid without it being pickled per call; each render() partitions
+# the rays into tiles and streams the rendered tiles back as they complete.
+#
+#   with RenderPool(world) as render_pool:
+#       renderer.render(render_pool=render_pool)
+class RenderPool:
+    def __init__(self, world, num_workers=None, tile_size=DEFAULT_RENDER_TILE_SIZE):
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.tile_size = tile_size
+        self.pool = tmp.Pool(self.num_workers, initializer=initialise_render_worker,
+                             initargs=(world.share_memory(),))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def render_tiles(self, camera, view_spec, ray_spec, ray_intersection_weights,
+                     clamping_function=ClampingFunctions.DEFAULT, renderer_options={}):
+        tiles = map(lambda weights: (camera, view_spec, ray_spec, weights, clamping_function, renderer_options),
+                    torch.split(ray_intersection_weights, self.tile_size))
+        return self.pool.imap(render_tile, tiles)
+
+    # Returns the colour channels of all the rays, and the total number of samples skipped by early ray
+    # termination across the tiles
+    def render_rays(self, camera, view_spec, ray_spec, ray_intersection_weights,
+                    clamping_function=ClampingFunctions.DEFAULT, renderer_options={}):
+        start_render_rays = timer()
+        red_tiles, green_tiles, blue_tiles, num_terminated_samples = zip(*self.render_tiles(
+            camera, view_spec, ray_spec, ray_intersection_weights, clamping_function, renderer_options))
+        log.info(f"Rendering on {self.num_workers} workers took {timer() - start_render_rays}")
+        return (torch.cat(red_tiles), torch.cat(green_tiles), torch.cat(blue_tiles), sum(num_terminated_samples))
+
+
 def stochastic_samples(num_stochastic_samples, view_spec):
     x_1, x_2 = view_spec[0], view_spec[1]
     y_1, y_2 = view_spec[2], view_spec[3]
@@ -964,10 +1607,14 @@ def stochastic_samples(num_stochastic_samples, view_spec):
     view_height = y_2 - y_1
 
     # Need to convert the range [Random(0,1), Random(0,1)] into bounds of [[x1, x2], [y1, y2]]
-    ray_intersection_weights = list(
-        map(lambda x: torch.mul(torch.rand(2), torch.tensor([view_length, view_height])) + torch.tensor(
-            [x_1, y_1]), list(range(0, num_stochastic_samples))))
-    return ray_intersection_weights
+    return torch.rand(num_stochastic_samples, 2) * torch.tensor([float(view_length), float(view_height)]) + \
+           torch.tensor([float(x_1), float(y_1)])
+
+
+# Draws num_rays rays uniformly across all the training views in one go: the index of the view of every ray,
+# and its view point on the view screen
+def ray_batch_samples(num_rays, num_views, view_spec):
+    return (torch.randint(num_views, (num_rays,)), stochastic_samples(num_rays, view_spec))
 
 
 def fullscreen_samples(view_spec):
@@ -976,29 +1623,48 @@ def fullscreen_samples(view_spec):
     num_view_samples_x = view_spec[4]
     num_view_samples_y = view_spec[5]
 
-    ray_intersection_weights = []
-    for i in np.linspace(x_1, x_2, int(num_view_samples_x)):
-        for j in np.linspace(y_1, y_2, int(num_view_samples_y)):
-            ray_intersection_weights.append(torch.tensor([i, j]))
+    view_xs = torch.linspace(float(x_1), float(x_2), int(num_view_samples_x))
+    view_ys = torch.linspace(float(y_1), float(y_2), int(num_view_samples_y))
+    ray_intersection_weights = torch.stack(torch.meshgrid(view_xs, view_ys, indexing="ij"), -1).reshape(-1, 2)
 
     log.info(f"Number of weights={len(ray_intersection_weights)}")
     return ray_intersection_weights
 
 
+# Scatters the colours of fullscreen rays back into (num_rays_y, num_rays_x) images. View points lie on
+# the fullscreen linspace grid, so they map back exactly onto pixel indices.
+def fullscreen_image(red_samples, green_samples, blue_samples, view_spec):
+    X, Y, INTENSITY = 0, 1, 2
+    view_x1, view_x2, view_y1, view_y2, num_rays_x, num_rays_y = view_spec
+    num_rays_x, num_rays_y = int(num_rays_x), int(num_rays_y)
+    step_x = float(view_x2 - view_x1) / max(num_rays_x - 1, 1)
+    step_y = float(view_y2 - view_y1) / max(num_rays_y - 1, 1)
+    column_indices = torch.round((red_samples[:, X] - float(view_x1)) / step_x).long()
+    row_indices = torch.round((red_samples[:, Y] - float(view_y1)) / step_y).long()
+    image = torch.zeros([3, num_rays_y, num_rays_x])
+    image[:, row_indices, column_indices] = torch.stack([red_samples[:, INTENSITY], green_samples[:, INTENSITY],
+                                                         blue_samples[:, INTENSITY]]).detach().float()
+
+    # Flip to prevent image being rendered upside down when saved to a file
+    return torch.flip(image, [1])
+
+
+# Maps view points to image pixel indices. x and y may be tensors of view point coordinates, giving
+# tensors of indices.
 def camera_to_image(x, y, view_spec):
     view_x1, view_x2, view_y1, view_y2, num_rays_x, num_rays_y = view_spec
     step_x = (view_x2 - view_x1) / num_rays_x
     step_y = (view_y2 - view_y1) / num_rays_y
 
     # (view_y2 - y) implies we are flipping the Y-axis
-    image_x = int((x - view_x1) / step_x)
-    image_y = int((view_y2 - y) / step_y)
+    image_x = torch.as_tensor((x - view_x1) / step_x).long()
+    image_y = torch.as_tensor((view_y2 - y) / step_y).long()
 
     # In the above calculation, [-1,1] maps to [0, num_rays]. Only +1 maps to num_rays.
     # We need to handle that isolated case and decrement by 1 to bring into the range
     #  of valid indices
-    image_x = image_x if image_x < num_rays_x else image_x - 1
-    image_y = image_y if image_y < num_rays_y else image_x - 1
+    image_x = torch.where(image_x < num_rays_x, image_x, image_x - 1)
+    image_y = torch.where(image_y < num_rays_y, image_y, image_y - 1)
     return (image_x, image_y)
 
 
@@ -1009,127 +1675,211 @@ def samples_to_image(red_samples, green_samples, blue_samples, view_spec, genera
     red_render_channel = generate_background_pixel([num_rays_y, num_rays_x])
     green_render_channel = generate_background_pixel([num_rays_y, num_rays_x])
     blue_render_channel = generate_background_pixel([num_rays_y, num_rays_x])
-    for index, pixel in enumerate(red_samples):
-        # print(
-        #     f"({view_y2 - pixel[1]}, {pixel[0] - view_x1}) -> ({int((view_y2 - pixel[1]) / step_y)}, {int((pixel[0] - view_x1) / step_x)}), {pixel[2]}")
-        x, y = camera_to_image(pixel[X], pixel[Y], view_spec)
-        red_render_channel[y - 1, x - 1] = red_samples[index][INTENSITY]
-        green_render_channel[y - 1, x - 1] = green_samples[index][INTENSITY]
-        blue_render_channel[y - 1, x - 1] = blue_samples[index][INTENSITY]
     image_data = torch.stack([red_render_channel, green_render_channel, blue_render_channel])
+    x, y = camera_to_image(red_samples[:, X], red_samples[:, Y], view_spec)
+    image_data[:, y - 1, x - 1] = torch.stack([red_samples[:, INTENSITY], green_samples[:, INTENSITY],
+                                               blue_samples[:, INTENSITY]])
     return image_data
 
 
-def mse(rendered_channel, true_channel, view_spec):
-    # true_channel = torch.ones([2, 2]) * 10
-    small_diffs = 0
-    medium_diffs = 0
-    large_diffs = 0
-    channel_total_error = torch.tensor(0.)
-    for point in rendered_channel:
-        x, y, intensity = point
-        intensity = intensity
-        image_x, image_y = camera_to_image(x, y, view_spec)
-        pixel_error = (true_channel[image_y, image_x] - intensity).pow(2)
-        # print(pixel_error)
-        if (pixel_error <= 0.001):
-            small_diffs += 1
-        elif (pixel_error > 0.001 and pixel_error <= 0.01):
-            medium_diffs += 1
-        else:
-            large_diffs += 1
-        channel_total_error += pixel_error
-
-    # print(f"Small diffs = {small_diffs}")
-    # print(f"Medium diffs = {medium_diffs}")
-    # print(f"Large diffs = {large_diffs}")
-    return channel_total_error / len(rendered_channel)
-
-
-def tv_for_voxel(voxel_accessor, world):
-    voxel_max_x, voxel_max_y, voxel_max_z = world.voxel_dimensions()
-    all_voxels = voxel_accessor.all_voxels
-    voxel_positions = voxel_accessor.voxel_positions
-    index = int(random.random() * len(all_voxels))
-    position = voxel_positions[index]
-    voxel = all_voxels[index]
-    x_plus_1 = position + torch.tensor([1, 0, 0])
-    y_plus_1 = position + torch.tensor([0, 1, 0])
-    z_plus_1 = position + torch.tensor([0, 0, 1])
-    # print(f"Position is {position}, TV coords are: {(x_plus_1, y_plus_1, z_plus_1)}")
-    voxel_x1 = world.voxel_by_position(*x_plus_1)
-    voxel_y1 = world.voxel_by_position(*y_plus_1)
-    voxel_z1 = world.voxel_by_position(*z_plus_1)
-    delta_x = ((voxel - voxel_x1) / (256 / voxel_max_x)).pow(2)
-    delta_y = ((voxel - voxel_y1) / (256 / voxel_max_y)).pow(2)
-    delta_z = ((voxel - voxel_z1) / (256 / voxel_max_z)).pow(2)
-
-    tv_regularisation_term = (delta_x + delta_y + delta_z + 0.0001).sqrt().sum()
-    if (math.isnan(tv_regularisation_term)):
+# Mean squared error of rendered samples of a channel against the true image channel. With
+# error_histogram set, the number of small, medium and large pixel errors is logged too.
+def mse(rendered_channel, true_channel, view_spec, error_histogram=False):
+    X, Y, INTENSITY = 0, 1, 2
+    image_x, image_y = camera_to_image(rendered_channel[:, X], rendered_channel[:, Y], view_spec)
+    pixel_errors = (true_channel[image_y, image_x] - rendered_channel[:, INTENSITY]).pow(2)
+    if error_histogram:
+        small_diffs = int((pixel_errors <= 0.001).sum())
+        medium_diffs = int(((pixel_errors > 0.001) & (pixel_errors <= 0.01)).sum())
+        large_diffs = len(pixel_errors) - small_diffs - medium_diffs
+        log.info(f"Small diffs = {small_diffs}, Medium diffs = {medium_diffs}, Large diffs = {large_diffs}")
+    return pixel_errors.mean()
+
+
+# Total variation of each voxel, summed over its channels: sqrt(dx^2 + dy^2 + dz^2 + epsilon), where each
+# difference is to the next voxel along that axis, scaled down by 256 / the size of the grid along that axis
+def total_variation(differences_x, differences_y, differences_z, world):
+    voxel_max_x, voxel_max_y, voxel_max_z = world.voxel_dimensions().float()
+    delta_x = (differences_x / (256 / voxel_max_x)).pow(2)
+    delta_y = (differences_y / (256 / voxel_max_y)).pow(2)
+    delta_z = (differences_z / (256 / voxel_max_z)).pow(2)
+    return (delta_x + delta_y + delta_z + TV_EPSILON).sqrt().sum(-1)
+
+
+# Mean total variation over every voxel of the grid, from differences between neighbouring slices along
+# each axis. Neighbours past the upper faces of the grid are empty voxels, so the differences on the
+# upper faces are the voxels themselves.
+def tv_over_grid(world):
+    voxels = world.dense_voxels()
+    differences_x = torch.cat([voxels[:-1] - voxels[1:], voxels[-1:]])
+    differences_y = torch.cat([voxels[:, :-1] - voxels[:, 1:], voxels[:, -1:]], 1)
+    differences_z = torch.cat([voxels[:, :, :-1] - voxels[:, :, 1:], voxels[:, :, -1:]], 2)
+    return total_variation(differences_x, differences_y, differences_z, world).mean()
+
+
+# Mean total variation over a (N, 3) tensor of voxel positions, with the voxels and their neighbours
+# fetched in one gather. Positions and neighbours outside the grid are empty voxels.
+def tv_at(world, voxel_positions):
+    if len(voxel_positions) == 0:
+        return torch.tensor(0.)
+    voxels = world.voxels_at(voxel_positions)
+    next_voxels = world.voxels_at(voxel_positions.unsqueeze(1) + torch.eye(3, dtype=voxel_positions.dtype))
+    differences = voxels.unsqueeze(1) - next_voxels
+    return total_variation(differences[:, 0], differences[:, 1], differences[:, 2], world).mean()
+
+
+# TV regularisation, in one of three modes:
+# "sampled" takes REGULARISATION_FRACTION of the voxel positions touched by the rays, at random with replacement,
+# "touched" takes every distinct voxel inside the grid which is touched by the rays,
+# "grid" takes every voxel of the grid, and needs a dense world.
+def tv_term(voxel_accessor, world, mode="sampled"):
+    if mode == "grid":
+        tv_regularisation_term = tv_over_grid(world)
+    elif mode == "touched":
+        voxel_positions = voxel_accessor.all_voxel_positions()
+        voxel_positions = voxel_positions[world.inside_grid_mask(voxel_positions)]
+        tv_regularisation_term = tv_at(world, world.distinct_voxel_positions(voxel_positions)[0])
+    elif mode == "sampled":
+        voxel_positions = voxel_accessor.all_voxel_positions()
+        num_voxels_to_include = int(REGULARISATION_FRACTION * len(voxel_positions))
+        sampled_indices = torch.randint(max(len(voxel_positions), 1), [num_voxels_to_include])
+        tv_regularisation_term = tv_at(world, voxel_positions[sampled_indices])
+    else:
+        raise ValueError(f"TV regularisation mode {mode} is not supported")
+
+    if torch.isnan(tv_regularisation_term):
         log.warning("[WARNING] NaN in TV regularisation term")
-        log.warning(
-            f"Sqrt sum={tv_regularisation_term}, Source voxel={voxel}, Positions are: {(x_plus_1, y_plus_1, z_plus_1)}, Voxels = {(voxel_x1, voxel_y1, voxel_z1)}, Deltas={(delta_x, delta_y, delta_z)}")
     return tv_regularisation_term
 
 
-def tv_term(voxel_accessor, world):
-    num_voxels_to_include = int(REGULARISATION_FRACTION * len(voxel_accessor.all_voxels))
-    return torch.stack(
-        list(map(lambda i: tv_for_voxel(voxel_accessor, world), list(range(num_voxels_to_include))))).mean()
-
-
 def modify_grad(parameter_world, voxel_access):
-    vx, vy, vz = parameter_world.voxel_dimensions()
-    for i, j, k, v in parameter_world.all_voxels():
-        v.requires_grad = False
-
-    activated_parameters = []
-    for ray_index, view_point in enumerate(voxel_access.view_points):
-        ray = voxel_access.for_ray(ray_index)
-        for i in range(ray.num_samples):
-            sample_position, voxel_positions, voxels = ray.at(i)
-            for voxel_position in voxel_positions:
-                x, y, z = voxel_position
-                if (x < 0 or x > vx - 1 or
-                        y < 0 or y > vy - 1 or
-                        z < 0 or z > vz - 1):
-                    continue
-                candidate_voxel = parameter_world.voxel_by_position(x, y, z)
-                if (Voxel.is_pruned(candidate_voxel)):
-                    continue
-                candidate_voxel.requires_grad = True
-                activated_parameters.append(torch.tensor([x, y, z]))
-
-    if activated_parameters:
-        log.info(f"Activated {len(torch.stack(activated_parameters).unique(dim=0))} parameters...")
+    voxel_positions = voxel_access.all_voxel_positions()
+    voxel_positions = voxel_positions[parameter_world.inside_grid_mask(voxel_positions)]
+    activated = torch.zeros(parameter_world.pruned.shape, dtype=torch.bool)
+    activated[voxel_positions[:, 0], voxel_positions[:, 1], voxel_positions[:, 2]] = True
+    activated &= ~parameter_world.pruned
+
+    parameter_world.activated = activated
+    num_activated_parameters = int(activated.sum())
+    if num_activated_parameters > 0:
+        log.info(f"Activated {num_activated_parameters} parameters...")
     else:
         log.warning(f"[WARNING] No parameters were activated!!")
 
 
+# Optimizer step which only changes the voxels activated by modify_grad(). Masking the gradient is not enough
+# on its own, since RMSprop keeps moving voxels with a zero gradient through their momentum, and decays
+# their running averages. So the RMSprop update of build_optimizer() is applied here directly, to the
+# trainable rows only: those rows of the parameter, square_avg and momentum_buffer are gathered with
+# index_select(), updated, and written back with index_copy_(). The other rows are never read or written.
+# The state is kept in RMSprop's own format, so the optimizer can still be saved or carried across levels.
+def masked_step(optimizer, model):
+    parameter = model.voxel_grid
+    if parameter.grad is None:
+        return
+    group = optimizer.param_groups[0]
+    state = optimizer.state[parameter]
+    if len(state) == 0:
+        state["step"] = torch.tensor(0.)
+        state["square_avg"] = torch.zeros_like(parameter)
+        if group["momentum"] > 0:
+            state["momentum_buffer"] = torch.zeros_like(parameter)
+    state["step"] += 1
+
+    voxel_dimension = parameter.shape[-1]
+    rows = model.world().storage_gradient_mask().reshape(-1).nonzero()[:, 0]
+    with torch.no_grad():
+        parameter_rows = parameter.view(-1, voxel_dimension)
+        grad = parameter.grad.reshape(-1, voxel_dimension).index_select(0, rows)
+        trained_rows = parameter_rows.index_select(0, rows)
+        if group["weight_decay"] != 0:
+            grad = grad.add(trained_rows, alpha=group["weight_decay"])
+        square_avg = state["square_avg"].view(-1, voxel_dimension)
+        square_avg_rows = square_avg.index_select(0, rows).mul_(group["alpha"])
+        square_avg_rows.addcmul_(grad, grad, value=1 - group["alpha"])
+        square_avg.index_copy_(0, rows, square_avg_rows)
+        avg = square_avg_rows.sqrt().add_(group["eps"])
+        if group["momentum"] > 0:
+            momentum_buffer = state["momentum_buffer"].view(-1, voxel_dimension)
+            momentum_rows = momentum_buffer.index_select(0, rows).mul_(group["momentum"]).addcdiv_(grad, avg)
+            momentum_buffer.index_copy_(0, rows, momentum_rows)
+            trained_rows.add_(momentum_rows, alpha=-group["lr"])
+        else:
+            trained_rows.addcdiv_(grad, avg, value=-group["lr"])
+        parameter_rows.index_copy_(0, rows, trained_rows)
+
+
+# The whole grid is a single parameter, so an optimizer step is a handful of fused kernels
+# instead of one update per voxel. The pruning mask is a buffer, so it is saved with the model.
+# Pruned voxels (and voxels not activated by modify_grad()) are excluded by masking their gradients,
+# rather than by flipping requires_grad on individual voxels.
+# Rays for each camera are built once and then served from a RayCache, unless cache_rays is False.
+# A ray_cache may be supplied instead, e.g. a RayStore, or the cache of a coarser model. Only forward(),
+# which renders whole images, uses the cache; render_ray_batch() builds fresh rays for every batch.
 class PlenoxelModel(nn.Module):
-    def __init__(self, world):
+    def __init__(self, world, transmittance_threshold=None, cache_rays=True, ray_cache=None):
         super().__init__()
-        self.parameter_world = VoxelGrid.as_parameter(world, self)
+        self.transmittance_threshold = transmittance_threshold
+        self.ray_cache = ray_cache if ray_cache is not None else RayCache() if cache_rays else None
+        self.voxel_grid = nn.Parameter(world.storage().detach().clone())
+        self.parameter_world = world.with_storage(self.voxel_grid, {name: buffer.clone() for name, buffer in
+                                                                    world.buffers().items()})
+        for name, buffer in self.parameter_world.buffers().items():
+            self.register_buffer(name, buffer)
+        self.voxel_grid.register_hook(self.mask_gradients)
 
     def world(self):
         return self.parameter_world
 
+    def mask_gradients(self, grad):
+        return grad * self.parameter_world.storage_gradient_mask()
+
+    def prune(self, pruning_mask):
+        self.parameter_world.prune_where(pruning_mask)
+
     # @profile
     def forward(self, input):
         camera, view_spec, ray_spec = input
         # Use self.parameter_world as the weights, take camera as input
-        renderer = Renderer(self.parameter_world, camera, view_spec, ray_spec)
+        renderer = Renderer(self.parameter_world, camera, view_spec, ray_spec,
+                            transmittance_threshold=self.transmittance_threshold)
         num_stochastic_rays = NUM_STOCHASTIC_RAYS
         # voxel_access = renderer.build_rays(stochastic_samples(num_stochastic_rays, view_spec))
-        voxel_access = renderer.build_rays(fullscreen_samples(view_spec))
+        if (self.ray_cache is not None):
+            voxel_access = self.ray_cache.fullscreen_rays(renderer)
+        else:
+            voxel_access = renderer.build_rays(fullscreen_samples(view_spec))
         r, g, b = renderer.render_from_rays(voxel_access)
         modify_grad(self.parameter_world, voxel_access)
         return r, g, b, renderer, voxel_access
 
+    # Renders a batch of rays drawn across many views; see MultiViewRenderer
+    def render_ray_batch(self, cameras, camera_indices, view_points, view_spec, ray_spec):
+        renderer = MultiViewRenderer(self.parameter_world, cameras, camera_indices, view_spec, ray_spec,
+                                     transmittance_threshold=self.transmittance_threshold)
+        voxel_access = renderer.build_rays(view_points)
+        r, g, b = renderer.render_from_rays(voxel_access)
+        modify_grad(self.parameter_world, voxel_access)
+        return r, g, b, renderer, voxel_access
 
-def cauchy_term(voxel_access, world):
-    all_unique_voxels = torch.stack(voxel_access.all_voxels)
-    return torch.log(1 + 2 * all_unique_voxels[:, 0].pow(2)).sum()
+
+# Cauchy sparsity loss on the densities, in one of two modes:
+# "touched" sums log(1 + 2 * density^2) over every voxel position touched by the rays. Voxels are touched
+# many times over, so each distinct voxel's density is gathered once and its term is weighted by the
+# number of times it is touched; positions outside the grid have no density and contribute nothing.
+# "grid" sums the same term once over every voxel of the grid. Empty voxels contribute nothing, so only
+# the stored voxels are summed over, which for a sparse world are its unpruned rows.
+def cauchy_term(voxel_access, world, mode="touched"):
+    if mode == "grid":
+        densities = world.stored_densities()
+        return torch.log(1 + 2 * densities.pow(2)).sum()
+    elif mode != "touched":
+        raise ValueError(f"Cauchy regularisation mode {mode} is not supported")
+    voxel_positions = voxel_access.all_voxel_positions()
+    voxel_positions = voxel_positions[world.inside_grid_mask(voxel_positions)]
+    distinct_voxel_positions, touch_counts = world.distinct_voxel_positions(voxel_positions)
+    densities = world.voxels_at(distinct_voxel_positions, channels=slice(0, 1))[:, 0]
+    return (torch.log(1 + 2 * densities.pow(2)) * touch_counts).sum()
 
 
 # @profile
@@ -1141,8 +1891,9 @@ def train_minibatch(model, optimizer, camera, view_spec, ray_spec, image_channel
     image = samples_to_image(r, g, b, view_spec, generate_background_pixel=Empty.ALL_EMPTY)
 
     log.info("Calculating loss...")
-    log.info(f"TV Regularising using {int(len(voxel_access.all_voxels) * REGULARISATION_FRACTION)} voxels...")
-    log.info(f"Cauchy Regularising using {len(voxel_access.all_voxels)} voxels...")
+    num_voxels = len(voxel_access.all_voxel_positions())
+    log.info(f"TV Regularising using {int(num_voxels * REGULARISATION_FRACTION)} voxels...")
+    log.info(f"Cauchy Regularising using {num_voxels} voxels...")
     red_mse = mse(r, image_channels[0], view_spec)
     green_mse = mse(g, image_channels[1], view_spec)
     blue_mse = mse(b, image_channels[2], view_spec)
@@ -1151,94 +1902,334 @@ def train_minibatch(model, optimizer, camera, view_spec, ray_spec, image_channel
                  CAUCHY_REGULARISATION_LAMBDA * cauchy_term(voxel_access, model.parameter_world)
     log.info(f"Loss={total_loss}, RGB MSE={(red_mse, green_mse, blue_mse)}")
     total_loss.backward()
-    log.info(f"Model parameters: {len(list(model.parameters()))}")
-    num_activated_parameters = 0
-    for param in model.parameters():
-        if (param.grad is None):
-            continue
-        num_activated_parameters += 1
-        # print(f"Param grad after={param.grad}")
-    log.info(f"Activated parameters tally with non-null gradient={num_activated_parameters}")
-    #     print(f"Gradients={torch.max(param.grad)}")
+    log.info(f"Activated voxels tally with non-null gradient={int(model.world().trainable().sum())}")
     # make_dot(total_mse, params=dict(list(model.named_parameters()))).render("mse", format="png")
     # make_dot(r, params=dict(list(model.named_parameters()))).render("channel", format="png")
-    optimizer.step()
+    masked_step(optimizer, model)
     return total_loss.detach(), renderer, image, voxel_access
 
 
-def render_training_images(camera_positions, focal_length, camera_look_at, world, view_spec, ray_spec, plt):
-    for index, p in enumerate(camera_positions):
-        c = Camera(focal_length, p, camera_look_at)
-        r = Renderer(world, c, view_spec, ray_spec)
-        red, green, blue = r.render(plt)
-        save_image(torch.stack([red, green, blue]), f"./images/cube/training/rotating-cube-{index:02}.png")
+# One optimiser step on num_rays rays drawn uniformly across all the training views. Every ray is compared
+# against the pixel it passes through in the training image of its own view; rays which miss the world
+# are left out, as they are when training on whole images.
+def train_ray_batch(model, optimizer, cameras, view_spec, ray_spec, training_images, num_rays, batch_index,
+                    epoch_index):
+    X, Y, INTENSITY = 0, 1, 2
+    optimizer.zero_grad()
+
+    camera_indices, view_points = ray_batch_samples(num_rays, len(cameras), view_spec)
+    r, g, b, renderer, voxel_access = model.render_ray_batch(cameras, camera_indices, view_points, view_spec,
+                                                             ray_spec)
+    image_x, image_y = camera_to_image(voxel_access.view_points[:, X], voxel_access.view_points[:, Y], view_spec)
+    true_pixels = training_images[camera_indices[voxel_access.ray_indices], :, image_y, image_x]
+    red_mse = (r[:, INTENSITY] - true_pixels[:, 0]).pow(2).mean()
+    green_mse = (g[:, INTENSITY] - true_pixels[:, 1]).pow(2).mean()
+    blue_mse = (b[:, INTENSITY] - true_pixels[:, 2]).pow(2).mean()
+    total_loss = red_mse + green_mse + blue_mse + \
+                 TV_REGULARISATION_LAMBDA * tv_term(voxel_access, model.parameter_world) + \
+                 CAUCHY_REGULARISATION_LAMBDA * cauchy_term(voxel_access, model.parameter_world)
+    log.info(f"Epoch {epoch_index}, ray batch {batch_index}: Loss={total_loss}, "
+             f"RGB MSE={(red_mse, green_mse, blue_mse)}")
+    total_loss.backward()
+    masked_step(optimizer, model)
+    return total_loss.detach()
+
+
+# Frames are rendered headless unless a plt is passed in for previewing them
+def render_training_images(camera_positions, focal_length, camera_look_at, world, view_spec, ray_spec, plt=None):
+    with RenderPool(world) as render_pool:
+        for index, p in enumerate(camera_positions):
+            c = Camera(focal_length, p, camera_look_at)
+            r = Renderer(world, c, view_spec, ray_spec, transmittance_threshold=EARLY_TERMINATION_TRANSMITTANCE)
+            red, green, blue = r.render(plt, render_pool=render_pool)
+            save_image(torch.stack([red, green, blue]), f"./images/cube/training/rotating-cube-{index:02}.png")
 
-    plt.show()
     log.info("Completed rendering images")
 
 
+# Prunes the prunable voxels among those touched by the given rays, returning their positions
 def prune_voxels(world, voxel_accessors):
-    pruned_voxels = []
+    touched = torch.zeros(world.pruned.shape, dtype=torch.bool)
     for voxel_accessor in voxel_accessors:
-        num_view_points = len(voxel_accessor.view_points)
-        for ray_index in range(num_view_points):
-            ray = voxel_accessor.for_ray(ray_index)
-            for voxel_position in ray.voxel_positions:
-                if world.prune(voxel_position):
-                    pruned_voxels.append(voxel_position)
-    return pruned_voxels
+        voxel_positions = voxel_accessor.all_voxel_positions()
+        voxel_positions = voxel_positions[world.inside_grid_mask(voxel_positions)]
+        touched[voxel_positions[:, 0], voxel_positions[:, 1], voxel_positions[:, 2]] = True
+    pruning_mask = world.pruning_mask() & touched
+    world.prune_where(pruning_mask)
+    return pruning_mask.nonzero()
 
 
+# Prunes the prunable voxels of the whole grid, returning their positions
 def prune_voxels2(world):
-    pruned_voxels = []
-    for i, j, k, v in world.all_voxels():
-        voxel_position = torch.tensor([i, j, k])
-        if world.prune(voxel_position):
-            pruned_voxels.append(voxel_position)
-    return pruned_voxels
-
-
-def train(world, camera_look_at, focal_length, view_spec, ray_spec, training_positions, final_camera, num_epochs):
-    to_tensor = transforms.Compose([transforms.ToTensor()])
-    CUBE_TRAINING_FOLDER = "./images/cube"
-    TABLE_TRAINING_FOLDER = "./images/table/small-png"
-    dataset = datasets.ImageFolder(TABLE_TRAINING_FOLDER, transform=to_tensor)
-    data_loader = torch.utils.data.DataLoader(dataset, batch_size=100, shuffle=False)
-    training_images = list(data_loader)[0][0]
+    pruning_mask = world.pruning_mask()
+    world.prune_where(pruning_mask)
+    return pruning_mask.nonzero()
+
+
+# The images of an image folder, decoded once into a single float16 tensor of (num_images, channels,
+# height, width) which later runs memory-map instead of decoding again. Images are in the sorted order
+# of ImageFolder, which is the order of the training positions, and there may be any number of them.
+# Alternatively, image_paths gives the images, and their order, explicitly.
+# The manifest records every source file with its size and modification time, so that adding, removing
+# or changing an image decodes the folder again. The camera positions of the images may be kept in the
+# manifest too.
+class TrainingImageCache:
+    FORMAT_VERSION = 1
+    MANIFEST_FILENAME = "manifest.json"
+    IMAGES_FILENAME = "images.bin"
+
+    def __init__(self, image_folder, cache_folder=TRAINING_IMAGE_CACHE_FOLDER, image_paths=None):
+        self.image_folder = image_folder
+        self.image_paths = image_paths
+        cache_key = os.path.abspath(image_folder) + ("" if image_paths is None else repr(list(image_paths)))
+        self.cache_folder = f"{cache_folder}/{hashlib.sha1(cache_key.encode()).hexdigest()}"
+
+    def source_files(self):
+        image_paths = self.image_paths
+        if (image_paths is None):
+            image_paths = [path for path, _ in datasets.ImageFolder(self.image_folder).samples]
+        return [[path, os.path.getsize(path), os.path.getmtime(path)] for path in image_paths]
+
+    def manifest(self):
+        manifest_filename = f"{self.cache_folder}/{TrainingImageCache.MANIFEST_FILENAME}"
+        if (not os.path.exists(manifest_filename)):
+            return None
+        with open(manifest_filename) as manifest_file:
+            return json.load(manifest_file)
+
+    def write_manifest(self, manifest):
+        with open(f"{self.cache_folder}/{TrainingImageCache.MANIFEST_FILENAME}", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    def load(self, camera_positions=None):
+        source_files = self.source_files()
+        manifest = self.manifest()
+        if (manifest is None or manifest["version"] != TrainingImageCache.FORMAT_VERSION
+                or manifest["source_files"] != source_files):
+            manifest = self.decode(source_files)
+        if (camera_positions is not None):
+            if (len(camera_positions) != manifest["images"]["shape"][0]):
+                log.warning(f"{len(camera_positions)} camera positions for {manifest['images']['shape'][0]} images")
+            manifest["camera_positions"] = torch.as_tensor(camera_positions).tolist()
+            self.write_manifest(manifest)
+        return map_tensor_file(f"{self.cache_folder}/{TrainingImageCache.IMAGES_FILENAME}", manifest["images"])
+
+    def camera_positions(self):
+        manifest = self.manifest()
+        if (manifest is None or "camera_positions" not in manifest):
+            return None
+        return torch.tensor(manifest["camera_positions"])
+
+    def decode(self, source_files):
+        to_tensor = transforms.ToTensor()
+        images = torch.stack([to_tensor(datasets.folder.default_loader(path)) for path, _, _ in source_files]).half()
+        os.makedirs(self.cache_folder, exist_ok=True)
+        manifest = {"version": TrainingImageCache.FORMAT_VERSION, "source_files": source_files,
+                    "images": write_tensor_file(f"{self.cache_folder}/{TrainingImageCache.IMAGES_FILENAME}", images)}
+        self.write_manifest(manifest)
+        log.info(f"Decoded {len(images)} training images from {self.image_folder} into {self.cache_folder}")
+        return manifest
+
+
+def load_training_images(camera_positions=None, image_folder=TABLE_TRAINING_FOLDER):
+    training_images = TrainingImageCache(image_folder).load(camera_positions)
 
     log.info(
         f"{training_images.shape[0]} images, {training_images.shape[1]} channels per image, resolution is {training_images.shape[2:]}")
-
-    model = PlenoxelModel(world)
-    optimizer = torch.optim.RMSprop(model.parameters(), lr=LEARNING_RATE, momentum=0.9)
+    return training_images
+
+
+# A view manifest lists every training view as the path of its image, relative to the manifest, with the
+# camera center, look-at point and focal length it was taken with:
+#
+#   {"views": [{"image": "training/01.png", "center": [x, y, z], "look_at": [x, y, z], "focal_length": f}, ...]}
+def read_view_manifest(filename):
+    with open(filename) as manifest_file:
+        views = json.load(manifest_file)["views"]
+    manifest_folder = os.path.dirname(filename)
+    image_paths = [os.path.join(manifest_folder, view["image"]) for view in views]
+    cameras = [Camera(view["focal_length"], torch.tensor(view["center"] + [1.]), torch.tensor(view["look_at"] + [1.]))
+               for view in views]
+    return image_paths, cameras
+
+
+# Writes a view manifest pairing the images of an ImageFolder, in its sorted order, with camera positions which
+# all look at the same point, as the training positions in this file do
+def write_view_manifest(filename, image_folder, camera_positions, look_at, focal_length):
+    manifest_folder = os.path.dirname(filename)
+    image_paths = [path for path, _ in datasets.ImageFolder(image_folder).samples]
+    views = [{"image": os.path.relpath(image_path, manifest_folder), "center": position[:3].tolist(),
+              "look_at": look_at[:3].tolist(), "focal_length": float(focal_length)}
+             for image_path, position in zip(image_paths, camera_positions)]
+    with open(filename, "w") as manifest_file:
+        json.dump({"views": views}, manifest_file, indent=2)
+
+
+# Iterates over the views of a view manifest in batches of (cameras, images), where images is a
+# (batch_size, channels, height, width) tensor. The images are decoded once through a TrainingImageCache,
+# and each batch is gathered from it on a background thread, up to num_prefetch batches ahead of the
+# training loop, so that image I/O stays off its critical path.
+class ViewLoader:
+    def __init__(self, manifest_filename, batch_size=VIEWS_PER_BATCH, shuffle=True, num_prefetch=2,
+                 cache_folder=TRAINING_IMAGE_CACHE_FOLDER):
+        image_paths, self.cameras = read_view_manifest(manifest_filename)
+        image_cache = TrainingImageCache(os.path.dirname(manifest_filename), cache_folder, image_paths)
+        self.images = image_cache.load(torch.stack([camera.center for camera in self.cameras]))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return math.ceil(len(self.cameras) / self.batch_size)
+
+    def __iter__(self):
+        num_views = len(self.cameras)
+        order = torch.randperm(num_views) if self.shuffle else torch.arange(num_views)
+        batches = torch.split(order, self.batch_size)
+        prefetched = queue.Queue(maxsize=self.num_prefetch)
+
+        def gather_batches():
+            try:
+                for view_indices in batches:
+                    prefetched.put(([self.cameras[index] for index in view_indices.tolist()],
+                                    self.images[view_indices]))
+                prefetched.put(None)
+            except Exception as e:
+                prefetched.put(e)
+
+        threading.Thread(target=gather_batches, daemon=True).start()
+        while True:
+            batch = prefetched.get()
+            if (batch is None):
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+
+def build_optimizer(model):
+    return torch.optim.RMSprop(model.parameters(), lr=LEARNING_RATE, momentum=0.9, foreach=True)
+
+
+# If ray_batches_per_epoch is given, every epoch takes that many steps on batches of NUM_STOCHASTIC_RAYS rays
+# drawn across all training views, instead of a step on the whole image of each view.
+def train_epochs(model, optimizer, camera_look_at, focal_length, view_spec, ray_spec, training_positions,
+                 training_images, epochs, prune_each_epoch=False, ray_batches_per_epoch=None):
     epoch_losses = []
-    voxel_accessors = []
-    for epoch in range(num_epochs):
+    cameras = [Camera(focal_length, position, camera_look_at) for position in training_positions]
+    for epoch in epochs:
         batch_losses = []
         log.info(f"In epoch {epoch}")
-        for batch, position in enumerate(training_positions[:1]):
-            log.info(f"Before Training for camera position #{batch}={position}")
-            test_camera = Camera(focal_length, position, camera_look_at)
-            minibatch_loss, renderer, image, voxel_access = train_minibatch(model, optimizer, test_camera, view_spec,
-                                                                            ray_spec,
-                                                                            training_images[batch], batch, epoch)
-            batch_losses.append(minibatch_loss)
-            # voxel_accessors.append(voxel_access)
-            log.info(f"After Training for camera position #{batch}={position}")
-            renderer.plot_from_image(image, plt, f"Epoch: {epoch} Image: {batch}")
-            save_image(image, f"{OUTPUT_FOLDER}/reconstruction/reconstruction-{epoch:02}-{batch:02}.png")
+        if ray_batches_per_epoch is not None:
+            for batch in range(ray_batches_per_epoch):
+                batch_losses.append(train_ray_batch(model, optimizer, cameras, view_spec, ray_spec, training_images,
+                                                    NUM_STOCHASTIC_RAYS, batch, epoch))
+        else:
+            for batch, test_camera in enumerate(cameras[:1]):
+                log.info(f"Before Training for camera position #{batch}={test_camera.center}")
+                minibatch_loss, renderer, image, voxel_access = train_minibatch(model, optimizer, test_camera,
+                                                                                view_spec, ray_spec,
+                                                                                training_images[batch], batch, epoch)
+                batch_losses.append(minibatch_loss)
+                log.info(f"After Training for camera position #{batch}={test_camera.center}")
+                renderer.plot_from_image(image, plt, f"Epoch: {epoch} Image: {batch}")
+                save_image(image, f"{OUTPUT_FOLDER}/reconstruction/reconstruction-{epoch:02}-{batch:02}.png")
 
         # torch.save(model.parameter_world, f"{OUTPUT_FOLDER}/models/table-{epoch}.pt")
         epoch_losses.append(batch_losses)
+        if prune_each_epoch:
+            log.info(f"Pruned {len(prune_voxels2(model.world()))} voxels after epoch {epoch}")
+    return epoch_losses
+
 
-    # pruned_voxels = prune_voxels(model.parameter_world, voxel_accessors)
-    # model.parameter_world.prune(pruned_voxels)
-    # print(f"Pruned {len(pruned_voxels)} voxels!!")
-    final_renderer = Renderer(model.world(), final_camera, view_spec, ray_spec)
-    red, green, blue = final_renderer.render(plt)
+def render_final(world, final_camera, view_spec, ray_spec):
+    final_renderer = Renderer(world, final_camera, view_spec, ray_spec,
+                              transmittance_threshold=EARLY_TERMINATION_TRANSMITTANCE)
+    with RenderPool(world) as render_pool:
+        red, green, blue = final_renderer.render(plt, render_pool=render_pool)
     transforms.ToPILImage()(torch.stack([red, green, blue])).show()
     log.info("Rendered final result")
     plt.show()
+
+
+# Ray geometry is only worth storing for full-image training, where every epoch renders the same rays again.
+# Ray batches are drawn afresh across all the views at every step, so no store is built for them.
+def training_model(world, ray_batches_per_epoch=None):
+    if ray_batches_per_epoch is not None:
+        return PlenoxelModel(world, cache_rays=False)
+    return PlenoxelModel(world, ray_cache=RayStore())
+
+
+def train(world, camera_look_at, focal_length, view_spec, ray_spec, training_positions, final_camera, num_epochs,
+          prune_each_epoch=False, ray_batches_per_epoch=None):
+    training_images = load_training_images(training_positions)
+    model = training_model(world, ray_batches_per_epoch)
+    optimizer = build_optimizer(model)
+    epoch_losses = train_epochs(model, optimizer, camera_look_at, focal_length, view_spec, ray_spec,
+                                training_positions, training_images, range(num_epochs), prune_each_epoch,
+                                ray_batches_per_epoch)
+    render_final(model.world(), final_camera, view_spec, ray_spec)
+    return model.parameter_world, epoch_losses
+
+
+# Trains on the views of a view manifest: every step draws NUM_STOCHASTIC_RAYS rays across one batch of
+# views from the ViewLoader, so each camera has its own pose and focal length
+def train_from_views(world, view_loader, view_spec, ray_spec, final_camera, num_epochs, prune_each_epoch=False):
+    model = PlenoxelModel(world, cache_rays=False)
+    optimizer = build_optimizer(model)
+    epoch_losses = []
+    for epoch in range(num_epochs):
+        log.info(f"In epoch {epoch}")
+        epoch_losses.append([train_ray_batch(model, optimizer, cameras, view_spec, ray_spec, images,
+                                             NUM_STOCHASTIC_RAYS, batch, epoch)
+                             for batch, (cameras, images) in enumerate(view_loader)])
+        if prune_each_epoch:
+            log.info(f"Pruned {len(prune_voxels2(model.world()))} voxels after epoch {epoch}")
+    render_final(model.world(), final_camera, view_spec, ray_spec)
+    return model.parameter_world, epoch_losses
+
+
+# Moves training up one resolution level. The model's world is upsampled, and every per-voxel tensor of
+# optimiser state (RMSprop's square_avg and momentum_buffer) is upsampled in exactly the same way, so the
+# running averages carry over to the child voxels. State of pruned voxels is cleared, so that momentum
+# cannot move them away from empty.
+def scale_up_model(model, optimizer, mode="trilinear"):
+    coarse_world = model.world()
+    fine_model = PlenoxelModel(coarse_world.scale_up(mode), transmittance_threshold=model.transmittance_threshold,
+                               cache_rays=model.ray_cache is not None, ray_cache=model.ray_cache)
+    fine_optimizer = build_optimizer(fine_model)
+    trainable = fine_model.world().storage_gradient_mask()
+    fine_state = fine_optimizer.state[fine_model.voxel_grid]
+    for name, value in optimizer.state[model.voxel_grid].items():
+        if torch.is_tensor(value) and value.shape == model.voxel_grid.shape:
+            value = coarse_world.with_storage(value, coarse_world.buffers()).scale_up(mode).storage() * trainable
+        fine_state[name] = value
+    return fine_model, fine_optimizer
+
+
+# Coarse-to-fine training: the world is trained for epochs_per_level[0] epochs at its own resolution,
+# then pruned and upsampled, and so on for each further level. Early epochs run on a small grid,
+# and pruning keeps empty space from being carried into the finer levels.
+def train_coarse_to_fine(world, camera_look_at, focal_length, view_spec, ray_spec, training_positions,
+                         final_camera, epochs_per_level, upsampling_mode="trilinear", ray_batches_per_epoch=None):
+    training_images = load_training_images(training_positions)
+    model = training_model(world, ray_batches_per_epoch)
+    optimizer = build_optimizer(model)
+    epoch_losses = []
+    first_epoch = 0
+    for level, num_epochs in enumerate(epochs_per_level):
+        log.info(f"Training level {level} at resolution {model.world().voxel_dimensions()}")
+        epoch_losses += train_epochs(model, optimizer, camera_look_at, focal_length, view_spec, ray_spec,
+                                     training_positions, training_images, range(first_epoch, first_epoch + num_epochs),
+                                     ray_batches_per_epoch=ray_batches_per_epoch)
+        first_epoch += num_epochs
+        if level == len(epochs_per_level) - 1:
+            break
+        pruned_voxels = prune_voxels2(model.world())
+        log.info(f"Pruned {len(pruned_voxels)} voxels after level {level}")
+        model, optimizer = scale_up_model(model, optimizer, upsampling_mode)
+
+    render_final(model.world(), final_camera, view_spec, ray_spec)
     return model.parameter_world, epoch_losses
 
 
@@ -1251,24 +2242,22 @@ def reconstruct_flyby_from_file(filename, camera_positions, focal_length, look_a
     reconstruct_flyby_from_world(reconstructed_world, camera_positions, focal_length, look_at, view_spec, ray_spec)
 
 
-def reconstruct_flyby_from_world(world, camera_positions, focal_length, look_at, view_spec, ray_spec):
+def reconstruct_flyby_from_world(world, camera_positions, focal_length, look_at, view_spec, ray_spec, plt=None):
     log.info("Constructing flyby...")
-    for index, view_point in enumerate(camera_positions):
-        c = Camera(focal_length, view_point, look_at)
-        r1 = Renderer(world, c, view_spec, ray_spec)
-        red, green, blue = r1.render(plt, text=f"Frame {index}")
-        save_image(torch.stack([red, green, blue]), f"{OUTPUT_FOLDER}/frames/animated-cube-{index:02}.png")
+    with RenderPool(world) as render_pool:
+        for index, view_point in enumerate(camera_positions):
+            c = Camera(focal_length, view_point, look_at)
+            r1 = Renderer(world, c, view_spec, ray_spec, transmittance_threshold=EARLY_TERMINATION_TRANSMITTANCE)
+            red, green, blue = r1.render(plt, text=f"Frame {index}", render_pool=render_pool)
+            save_image(torch.stack([red, green, blue]), f"{OUTPUT_FOLDER}/frames/animated-cube-{index:02}.png")
     log.info("Finished constructing flyby!!")
 
 
 def model_stats(filename, plt):
     model_tensor = torch.load(filename)
     world = VoxelGrid(model_tensor)
-    all_opacities = []
-    for i, j, k, v in world.all_voxels():
-        all_opacities.append(v[0].detach())
     plt.figure()
-    plt.hist(all_opacities, bins=50)
+    plt.hist(world.densities().flatten().numpy(), bins=50)
     pruned_voxels = prune_voxels2(world)
     log.info(f"Pruned voxels = {len(pruned_voxels)}")
     plt.show()
@@ -1282,7 +2271,9 @@ def test_upscale_rendering(world, original_renderer, camera, view_spec, ray_spec
     test_rendering(original_renderer, view_spec)
 
 
-def run_training(world, camera, view_spec, ray_spec):
+# If epochs_per_level is given, the world is trained coarse-to-fine, and should be built at the coarsest level.
+# If view_manifest is given, the world is trained on the views it lists instead of the table training positions.
+def run_training(world, camera, view_spec, ray_spec, epochs_per_level=None, view_manifest=None):
     focal_length = camera.focal_length
     camera_look_at = camera.look_at
 
@@ -1292,8 +2283,17 @@ def run_training(world, camera, view_spec, ray_spec):
     # training_positions = cube_training_positions()
     training_positions = table_training_positions()
     num_epochs = 30
-    reconstructed_world, epoch_losses = train(world, camera_look_at, focal_length, view_spec, ray_spec,
-                                              training_positions, camera, num_epochs)
+    if view_manifest is not None:
+        reconstructed_world, epoch_losses = train_from_views(world, ViewLoader(view_manifest), view_spec, ray_spec,
+                                                             camera, num_epochs)
+    elif epochs_per_level is not None:
+        reconstructed_world, epoch_losses = train_coarse_to_fine(world, camera_look_at, focal_length, view_spec,
+                                                                 ray_spec, training_positions, camera, epochs_per_level,
+                                                                 ray_batches_per_epoch=RAY_BATCHES_PER_EPOCH)
+    else:
+        reconstructed_world, epoch_losses = train(world, camera_look_at, focal_length, view_spec, ray_spec,
+                                                  training_positions, camera, num_epochs,
+                                                  ray_batches_per_epoch=RAY_BATCHES_PER_EPOCH)
     log.info(f"Epoch losses = {epoch_losses}")
     torch.save(reconstructed_world.voxel_grid, RECONSTRUCTED_WORLD_FILENAME)
     log.info(f"Saved world to {RECONSTRUCTED_WORLD_FILENAME}!")
@@ -1328,13 +2328,47 @@ def test_rendering(renderer, view_spec):
     log.info("Finished rendering!!")
 
 
+def benchmark_spherical_harmonics(num_samples=100000):
+    directions = SphericalHarmonics.directions_from_angles(torch.rand([num_samples, 2]) * math.pi)
+    for degree in range(SphericalHarmonics.MAX_DEGREE + 1):
+        harmonics = SphericalHarmonics(degree)
+        harmonic_coefficients = torch.rand([num_samples, 3, harmonics.num_basis_functions()])
+        start_colours = timer()
+        SphericalHarmonics.colours(harmonic_coefficients, harmonics.basis(directions))
+        end_colours = timer()
+        log.info(f"Degree {degree}: evaluating {num_samples} colours took {end_colours - start_colours}")
+
+
+# Times a full frame rendered in-process, then on persistent pools of each size, and appends the
+# timings to a file so that runs on different machines can be compared. Each row is
+# (CPU count, workers, seconds per frame); pool sizes beyond the CPU count only measure pool overhead.
+def benchmark_render_pool(renderer, worker_counts=(1, 2, 4, 8), num_frames=3,
+                          filename=f"{OUTPUT_FOLDER}/render-pool-benchmark.csv"):
+    start_in_process = timer()
+    for _ in range(num_frames):
+        renderer.render()
+    timings = [("in-process", (timer() - start_in_process) / num_frames)]
+    for num_workers in worker_counts:
+        with RenderPool(renderer.world, num_workers=num_workers) as render_pool:
+            start_pool = timer()
+            for _ in range(num_frames):
+                renderer.render(render_pool=render_pool)
+            timings.append((num_workers, (timer() - start_pool) / num_frames))
+
+    with open(filename, "a") as benchmark_file:
+        for workers, seconds_per_frame in timings:
+            log.info(f"Workers={workers}: {seconds_per_frame} seconds per frame")
+            benchmark_file.write(f"{os.cpu_count()},{workers},{seconds_per_frame}\n")
+    return timings
+
+
 def main():
     random_world = VoxelGrid.build_random_world(GRID_X, GRID_Y, GRID_Z)
     mono_world = VoxelGrid.build_with_voxel(GRID_X, GRID_Y, GRID_Z, torch.cat(
         [torch.tensor([0.0002, random.random() * 100.]), torch.zeros(VoxelGrid.VOXEL_DIMENSION - 2)]))
     empty_world = VoxelGrid.build_empty_world(GRID_X, GRID_Y, GRID_Z)
     empty_world.build_hollow_cube_with_randomly_coloured_sides(
-        Voxel.uniform_harmonic_random_colour(density=0.4, requires_grad=True),
+        Voxel.uniform_harmonic_random_colour(density=0.4),
         torch.tensor([10, 10, 10, 20, 20, 20]))
     world = random_world
     # empty_world.build_solid_cube(torch.tensor([10, 10, 10, 20, 20, 20]))
@@ -1360,6 +2394,7 @@ def main():
 
     renderer = Renderer(world, camera, view_spec, ray_spec)
     # test_rendering(renderer, view_spec)
+    # benchmark_render_pool(renderer)
 
     # Generates training images
     # camera_positions = generate_camera_angles(camera_radius, cube_center)
@@ -1367,6 +2402,8 @@ def main():
 
     # upscaled_world = world.scale_up()
     run_training(world, camera, view_spec, ray_spec)
+    # coarse_world = VoxelGrid.build_random_world(GRID_X // 2, GRID_Y // 2, GRID_Z // 2, scale=VoxelGrid.DEFAULT_SCALE * 2)
+    # run_training(coarse_world, camera, view_spec, ray_spec, epochs_per_level=[10, 20])
     # test_rendering(renderer, view_spec)
     # test_upscale_rendering(world, renderer, camera, view_spec, ray_spec)
 